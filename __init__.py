@@ -1,25 +1,32 @@
-from . import utils, fitting
-import sys
+import sys, copy, importlib
+
+# submodules are imported on first access, so `import zcal` stays light
+# (dynesty and matplotlib are only loaded by the methods that need them)
+submodules = ['utils', 'grid', 'cache', 'store', 'plotting', 'stats', 'fitting', 'batch', 'runs', 'catalogue', 'emulator', 'bench', 'reweight', 'workers', 'mocks']
+
+def __getattr__(name:str):
+    if name in submodules:
+        return importlib.import_module(f'.{name}', __name__)
+    raise AttributeError(f"module 'zcal' has no attribute '{name}'")
 
 # set options
 def SetOptions(calibrations:dict, errors:dict, options:dict, wavelengths:dict, scheme:str):
+    from . import utils
     
     # set scheme
     options['scheme'] = scheme
 
+    # registered calibration scheme (see utils.schemes / utils.RegisterScheme)
+    entry = utils.schemes.get(scheme.lower())
+    if entry is None:
+        print('-> [zcal]: incorrect calibration scheme provided. Exiting...')
+        sys.exit()
+
     # ranges (0.01 to 2 solar)
-    if scheme.lower() == 'sanders':
-        options['range'] = [6.7, 9.0]
-    elif scheme.lower() == 'bian':
-        options['range'] = [6.7, 9.0]
-    elif scheme.lower() == 'nakajima':
-        options['range'] = [6.7, 9.0] # varies for diagnostic
+    options['range'] = list(entry['range'])
 
     # misc options
-    options['verbose']      = False
-    options['corner_plots'] = True
-    options['save_pkl']     = True
-    options['dust_correct'] = False
+    options.update(copy.deepcopy(defaults))
 
     # set all applicable line wavelengths (microns)
     wavelengths['oiii5007'] = 0.500824
@@ -29,65 +36,28 @@ def SetOptions(calibrations:dict, errors:dict, options:dict, wavelengths:dict, s
     
     #wavelengths['oiii4960'] = 0.496030                  
 
-    # set calibrations and errors
-    if scheme.lower() == 'sanders':
-        # set calibrations
-        calibrations['O3']    = utils.SandersO3
-        calibrations['O2']    = utils.SandersO2
-        calibrations['R23']   = utils.SandersR23
-        calibrations['O32']   = utils.SandersO32
-        calibrations['Ne3O2'] = utils.SandersNe3O2
-        # set errors
-        errors['O3']    = 0.09 #0.02
-        errors['O2']    = 0.22 #0.07
-        errors['R23']   = 0.06 #0.02
-        errors['O32']   = 0.29 #0.09
-        errors['Ne3O2'] = 0.24 #0.07
-        # conversions
-        options['x_to_oh'] = utils.Sanders_logOH
-        options['oh_to_x'] = utils.Sanders_x
-    elif scheme.lower() == 'bian':
-        # set calibrations
-        calibrations['O3']    = utils.BianO3
-        calibrations['O2']    = utils.BianO2 
-        calibrations['R23']   = utils.BianR23
-        calibrations['O32']   = utils.BianO32
-        calibrations['Ne3O2'] = utils.BianNe3O2
-        # set errors
-        errors['O3']    = 0.10
-        errors['O2']    = 0.13
-        errors['R23']   = 0.08
-        errors['O32']   = 0.19
-        errors['Ne3O2'] = 0.20
-        # conversions
-        options['x_to_oh'] = utils.Bian_logOH
-        options['oh_to_x'] = utils.Bian_x
-    elif scheme.lower() == 'nakajima':
-        # set calibrations
-        calibrations['O3']    = utils.NakajimaO3
-        calibrations['O2']    = utils.NakajimaO2 
-        calibrations['R23']   = utils.NakajimaR23
-        calibrations['O32']   = utils.NakajimaO32
-        calibrations['Ne3O2'] = utils.NakajimaNe3O2
-        # set errors
-        errors['O3']    = 0.16
-        errors['O2']    = 0.27
-        errors['R23']   = 0.10
-        errors['O32']   = 0.39
-        errors['Ne3O2'] = 0.39
-        # conversions
-        options['x_to_oh'] = utils.Nakajima_logOH
-        options['oh_to_x'] = utils.Nakajima_x
-    else:
-        print('-> [zcal]: incorrect calibration scheme provided. Exiting...')
-        sys.exit()
+    # set calibrations, errors and conversions
+    calibrations.update(entry['calibrations'])
+    errors.update(entry['errors'])
+    options['x_to_oh'] = entry['x_to_oh']
+    options['oh_to_x'] = entry['oh_to_x']
 
 def Initialise(scheme:str) -> None:
     SetOptions(calibrations, calib_errors, options, wavelengths, scheme)
 
+# default runtime options (fits read these, they no longer reset them)
+defaults = {'verbose': False, 'corner_plots': True, 'save_pkl': True, 'dust_correct': False,
+            'method': 'dynesty', 'ebv_max': 2., 'grid': {'n_oh': 200, 'n_ebv': 100, 'refine': 1}, 'quad': {'n': 2001},
+            'laplace': {'n_coarse': 60, 'delta_logl': 3., 'n_sigma': 2.}, 'mc': {'n_draws': 1000},
+            'cache_dir': None, 'cache_max_bytes': None,
+            'output': 'pickle', 'store_dir': None, 'store_samples': 500, 'store_shard_size': 256,
+            'checkpoint_dir': None, 'checkpoint_every': 60, 'stats': False, 'profile_dir': None,
+            'emulator': None, 'sampler': {'nlive': 500, 'dynamic': False, 'pool': None, 'queue_size': None,
+                                      'adaptive': False, 'tol': 0.01}}
+
 # set parameters
 calibrations = {}
 calib_errors = {}
 wavelengths = {}
-options = {}
+options = copy.deepcopy(defaults)
 scheme = ''
@@ -0,0 +1,232 @@
+# imports
+import zcal
+from zcal import utils, grid, fitting, stats
+import numpy as np
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
+
+# lines fitted, in the order passed to the FitZg_* methods
+lines = ['oiii', 'oii', 'hb', 'neiii']
+
+# structured summary returned for each object (values, upper and lower errors)
+result_dtype = [('id', 'U64'),
+                ('logOHp12', 'f8'), ('logOHp12_up', 'f8'), ('logOHp12_lo', 'f8'),
+                ('EBV', 'f8'), ('EBV_up', 'f8'), ('EBV_lo', 'f8')]
+
+# per-object stats records and their summary from the last FitCatalogue (when options['stats'] is set)
+last_stats = None
+
+# -=-=-=- WORKER METHODS -=-=-=-
+
+def _InitWorker(options:dict, schemes:dict = None) -> None:
+    """ Copies the parent's runtime options (output directories etc.) and registered schemes into a worker """
+    if schemes is not None:
+        utils.SyncSchemes(schemes)
+    zcal.options.update(options)
+
+def _FitObject(task:tuple) -> tuple:
+    """ Fits a single object, returning (logOHp12, EBVs) summaries and its stats record (or None) """
+
+    id, scheme, fluxes, dust, seed, options = task
+    rstate = None if seed is None else np.random.default_rng(seed)
+    stats.Reset()
+
+    try:
+        if dust:
+            logOHp12, EBVs = fitting.FitZg_DustCorrect(id, scheme, *fluxes, rstate=rstate, options=options)
+        else:
+            logOHp12, EBVs = fitting.FitZg_NoDust(id, scheme, *fluxes, rstate=rstate, options=options), np.full(3, np.nan)
+    except Exception as e:
+        print(f'-> [zcal]: fit failed for object {id} ({e}).')
+        logOHp12, EBVs = np.ones(3) * -999.0, np.ones(3) * -999.0
+    return logOHp12, EBVs, stats.Last()
+
+# -=-=-=- CATALOGUE FITTING -=-=-=-
+
+def ObjectSeeds(seed, ids:np.ndarray) -> list:
+    """ Independent seed of each object derived from (seed, id), so it does not depend on catalogue order
+        (None, i.e. fresh entropy and uncached random state, for every object if seed is None) """
+    if seed is None:
+        return [None] * len(ids)
+    base = [int(s) for s in np.atleast_1d(seed)]
+    return [np.random.SeedSequence(base + np.frombuffer(hashlib.sha256(str(id).encode()).digest()[:16], dtype=np.uint32).tolist())
+            for id in ids]
+
+def Executor(nworkers:int = None) -> ProcessPoolExecutor:
+    """ Process pool whose workers start with this process's runtime options (reusable across FitCatalogue calls) """
+    options = {key:value for key, value in zcal.options.items() if not callable(value)}
+    return ProcessPoolExecutor(max_workers=nworkers, initializer=_InitWorker, initargs=(options, utils.schemes))
+
+def FitCatalogue(ids:np.ndarray, scheme:str, oiii:np.ndarray, oii:np.ndarray, hb:np.ndarray, neiii:np.ndarray,
+                 dust:bool = True, nworkers:int = None, chunksize:int = 8, seed:int = None, executor = None) -> np.ndarray:
+    """ Fits a catalogue of (N, 2) flux/error arrays across a process pool (or a given executor), returning a structured array """
+
+    ids = np.atleast_1d(ids).astype(str)
+    fluxes = [np.asarray(f, dtype=float).reshape(len(ids), 2) for f in (oiii, oii, hb, neiii)]
+    fitting.CheckMethod(zcal.options, dust)
+
+    # broadcast grid / Monte Carlo engines (no per-object processes needed)
+    if zcal.options['method'] == 'grid' or (zcal.options['method'] == 'mc' and not dust):
+        results = np.zeros(len(ids), dtype=result_dtype)
+        results['id'] = ids
+        if zcal.options['method'] == 'grid':
+            settings = {key:value for key, value in zcal.options['grid'].items() if key in ('n_oh', 'n_ebv')}
+            logOHp12, EBVs = GridCatalogue(scheme, *fluxes, dust=dust, ebv_range=(0., zcal.options['ebv_max']), **settings)
+        else:
+            logOHp12, EBVs = MonteCarloCatalogue(scheme, *fluxes, seed=seed, **zcal.options['mc']), np.full((len(ids), 3), np.nan)
+        # summaries of every fitted object are written as per-object fits write theirs
+        for i in np.flatnonzero(logOHp12[:, 0] != -999.0):
+            fitting.SaveSummary(zcal.options['method'], ids[i], utils.GetScheme(scheme),
+                                {'logOHp12': logOHp12[i], 'EBV': EBVs[i]}, zcal.options)
+        for i, name in enumerate(['logOHp12', 'logOHp12_up', 'logOHp12_lo']):
+            results[name] = logOHp12[:, i]
+        for i, name in enumerate(['EBV', 'EBV_up', 'EBV_lo']):
+            results[name] = EBVs[:, i]
+        return results
+
+    # independent, reproducible seed for each object
+    seeds = ObjectSeeds(seed, ids)
+    tasks = [(ids[i], scheme, [f[i] for f in fluxes], dust, seeds[i], None) for i in range(len(ids))]
+
+    # fan out (results are returned in catalogue order)
+    if nworkers == 1:
+        fits = list(map(_FitObject, tasks))
+    elif executor is not None:
+        fits = list(executor.map(_FitObject, tasks, chunksize=chunksize))
+    else:
+        with Executor(nworkers) as executor:
+            fits = list(executor.map(_FitObject, tasks, chunksize=chunksize))
+
+    # collect summaries (and stats)
+    global last_stats
+    if zcal.options['stats']:
+        last_stats = {'fits': [fit[2] for fit in fits], 'summary': stats.Aggregate([fit[2] for fit in fits])}
+    results = np.zeros(len(ids), dtype=result_dtype)
+    results['id'] = ids
+    for i, (logOHp12, EBVs, _) in enumerate(fits):
+        results[i]['logOHp12'], results[i]['logOHp12_up'], results[i]['logOHp12_lo'] = logOHp12
+        results[i]['EBV'], results[i]['EBV_up'], results[i]['EBV_lo'] = EBVs
+    return results
+
+def GridCatalogue(scheme:str, oiii:np.ndarray, oii:np.ndarray, hb:np.ndarray, neiii:np.ndarray, dust:bool = True,
+                  n_oh:int = 200, n_ebv:int = 100, ebv_range:tuple = (0., 2.), max_bytes:int = 2**28) -> tuple:
+    """ Grid posteriors of M objects x G grid points in one broadcast, returning (M, 3) summaries """
+
+    scheme = utils.GetScheme(scheme)
+
+    # fluxes, diagnostic weights and per-object availability (the dust-corrected
+    # fit uses the full [OIII] doublet for every scheme, as FitZg_DustCorrect)
+    flux, flux_err = fitting.LineFluxes(oiii, oii, hb, neiii)
+    num, den = fitting.RatioWeights(scheme.name, nakajima=not dust)
+    mask, valid = fitting.DiagnosticMask(scheme.name, flux)
+
+    # grid, model ratios and dust corrections shared by every object
+    oh = np.linspace(scheme.range[0] - 12., scheme.range[1] - 12., n_oh)
+    ebv = np.linspace(*ebv_range, n_ebv) if dust else np.zeros(1)
+    model = utils.Horner(utils.CoefficientTable(scheme, fitting.diagnostics), scheme.oh_to_x(oh))
+    model_errs = np.array([scheme.errors[cal] for cal in fitting.diagnostics])
+    corrections = np.power(10, 0.4 * ebv[:, None] * utils.Cardelli_k(list(scheme.wavelengths.values())))
+
+    # objects per chunk, bounding the (chunk, n_oh, n_ebv, 5) likelihood terms
+    chunk = max(1, int(max_bytes // (8 * len(oh) * len(ebv) * len(fitting.diagnostics))))
+
+    logOHp12 = np.ones((len(flux), 3)) * -999.0
+    EBVs = np.ones((len(flux), 3)) * -999.0
+    for start in range(0, len(flux), chunk):
+        rows = np.arange(start, min(start + chunk, len(flux)))
+        rows = rows[valid[rows]]
+        if len(rows) == 0:
+            continue
+
+        # observed ratios at every E(B-V), shape (m, n_ebv, 5)
+        f, e = flux[rows, None, :] * corrections, flux_err[rows, None, :] * corrections
+        nf, df = f @ num.T, f @ den.T
+        with np.errstate(all='ignore'):
+            y = np.log10(nf / df)
+            yerr = np.sqrt((e ** 2 @ num.T ** 2) / nf ** 2 + (e ** 2 @ den.T ** 2) / df ** 2) / np.log(10)
+        m = mask[rows, None, :]
+        y = np.where(m, y, 0.)
+        var = np.where(m, yerr ** 2 + model_errs ** 2, 1.)
+        norm = np.sum(np.where(m, 2 * np.log(np.where(m, yerr, 1.) + model_errs), 0.), axis=-1)
+
+        # log-likelihood over (m, n_oh, n_ebv)
+        chi2 = np.where(m[:, None], (model[None, :, None, :] - y[:, None]) ** 2 / var[:, None], 0.)
+        logl = -0.5 * (np.sum(chi2, axis=-1) + norm[:, None, :])
+        post = np.exp(logl - np.max(logl, axis=(1, 2), keepdims=True))
+
+        # marginal quantiles
+        q_oh = grid.GridQuantiles(oh, post.sum(axis=2))
+        logOHp12[rows] = np.column_stack([q_oh[:, 1]+12, q_oh[:, 2]-q_oh[:, 1], q_oh[:, 1]-q_oh[:, 0]])
+        if dust:
+            q_ebv = grid.GridQuantiles(ebv, post.sum(axis=1))
+            EBVs[rows] = np.column_stack([q_ebv[:, 1], q_ebv[:, 2]-q_ebv[:, 1], q_ebv[:, 1]-q_ebv[:, 0]])
+        else:
+            EBVs[rows] = np.nan
+
+    return logOHp12, EBVs
+
+def MonteCarloCatalogue(scheme:str, oiii:np.ndarray, oii:np.ndarray, hb:np.ndarray, neiii:np.ndarray, n_draws:int = 1000,
+                        seed = None, min_fraction:float = 0.5, max_bytes:int = 2**28) -> np.ndarray:
+    """ Quick-look (no dust) log(O/H) of M objects from n_draws flux realisations each, returning (M, 3) summaries
+
+    every draw (with calibration scatter added to its ratios) is inverted through each active calibration's
+    branches, keeping the candidate that best matches all of them; objects where fewer than min_fraction
+    of the draws invert inside the scheme range are flagged with -999 """
+
+    scheme = utils.GetScheme(scheme)
+    rng = np.random.default_rng(seed)
+
+    # fluxes, diagnostic weights and per-object availability (as the no-dust fit)
+    flux, flux_err = fitting.LineFluxes(oiii, oii, hb, neiii)
+    num, den = fitting.RatioWeights(scheme.name, nakajima=True)
+    mask, valid = fitting.DiagnosticMask(scheme.name, flux)
+    coeffs = utils.CoefficientTable(scheme, fitting.diagnostics)
+    model_errs = np.array([scheme.errors[cal] for cal in fitting.diagnostics])
+    nbranch = sum(len(utils.InverseTable(scheme, cal)) for cal in fitting.diagnostics)
+
+    # observed ratio uncertainties weight the calibrations when choosing between candidates
+    nf, df = flux @ num.T, flux @ den.T
+    with np.errstate(all='ignore'):
+        yerr = np.sqrt((flux_err ** 2 @ num.T ** 2) / nf ** 2 + (flux_err ** 2 @ den.T ** 2) / df ** 2) / np.log(10)
+    var = np.where(mask, yerr ** 2 + model_errs ** 2, 1.)
+
+    # objects per chunk, bounding the (chunk, n_draws, candidates, 5) model ratios
+    chunk = max(1, int(max_bytes // (8 * n_draws * max(nbranch, 1) * len(fitting.diagnostics))))
+
+    logOHp12 = np.ones((len(flux), 3)) * -999.0
+    for start in range(0, len(flux), chunk):
+        rows = np.arange(start, min(start + chunk, len(flux)))
+        rows = rows[valid[rows]]
+        if len(rows) == 0:
+            continue
+
+        # flux realisations and their ratios with calibration scatter, shape (m, n_draws, 5)
+        f = flux[rows, None, :] + flux_err[rows, None, :] * rng.standard_normal((len(rows), n_draws, flux.shape[1]))
+        with np.errstate(all='ignore'):
+            y = np.log10((f @ num.T) / (f @ den.T)) + model_errs * rng.standard_normal((len(rows), n_draws, len(model_errs)))
+        m = mask[rows, None, :] & np.isfinite(y)
+
+        # candidate log(O/H) from every branch of every active calibration, shape (m, n_draws, candidates)
+        candidates = np.concatenate([np.where(m[..., i, None], utils.Invert(scheme, cal, y[..., i]), np.nan)
+                                     for i, cal in enumerate(fitting.diagnostics)], axis=-1)
+
+        # keep the candidate closest to all calibrations (exact ties, e.g. both branches of a
+        # single calibration, are broken at random)
+        model = utils.Horner(coeffs, scheme.oh_to_x(candidates))
+        chi2 = np.sum(np.where(m[:, :, None], (model - np.where(m, y, 0.)[:, :, None]) ** 2 / var[rows, None, None], 0.), axis=-1)
+        chi2 = np.where(np.isfinite(candidates), chi2, np.inf) + rng.uniform(0., 1e-9, chi2.shape)
+        best = np.argmin(chi2, axis=-1)
+        oh = np.take_along_axis(candidates, best[..., None], axis=-1)[..., 0]
+
+        # marginal quantiles of the inverted draws
+        ok = np.mean(np.isfinite(oh), axis=1) >= min_fraction
+        if np.any(ok):
+            q = np.nanpercentile(oh[ok], [16, 50, 84], axis=1).T
+            logOHp12[rows[ok]] = np.column_stack([q[:, 1]+12, q[:, 2]-q[:, 1], q[:, 1]-q[:, 0]])
+
+    return logOHp12
+
+def FitTable(table, scheme:str, id_col:str = 'id', **kwargs) -> np.ndarray:
+    """ Fits a table (structured array, dict or DataFrame) with {line} and {line}_err columns """
+    fluxes = [np.column_stack([table[line], table[f'{line}_err']]) for line in lines]
+    return FitCatalogue(np.asarray(table[id_col]), scheme, *fluxes, **kwargs)
@@ -0,0 +1,243 @@
+# imports
+import zcal
+from zcal import mocks
+import numpy as np
+import os, sys, json, time, subprocess, contextlib
+
+# modules that must not be loaded by a plain import (only on first use)
+heavy_modules = ['dynesty', 'matplotlib', 'scipy', 'uncertainties']
+
+# -=-=-=- IMPORT BENCHMARK -=-=-=-
+
+_import_probe = """
+import sys, time, json
+t = time.perf_counter()
+import {module}
+dt = time.perf_counter() - t
+print(json.dumps({{'seconds': dt, 'loaded': [m for m in {heavy} if m in sys.modules]}}))
+"""
+
+def _Env() -> dict:
+    """ Environment of a fresh interpreter that imports this copy of zcal """
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    return dict(os.environ, PYTHONPATH=os.pathsep.join([root, os.environ.get('PYTHONPATH', '')]))
+
+def ImportTime(module:str = 'zcal', repeats:int = 5) -> dict:
+    """ Times importing a zcal module in fresh interpreters, recording which heavy backends it pulls in """
+    runs = []
+    for _ in range(repeats):
+        out = subprocess.run([sys.executable, '-c', _import_probe.format(module=module, heavy=heavy_modules)],
+                             env=_Env(), capture_output=True, text=True, check=True)
+        runs.append(json.loads(out.stdout))
+    seconds = sorted(run['seconds'] for run in runs)
+    return {'module': module, 'median_s': seconds[len(seconds) // 2], 'min_s': seconds[0],
+            'loaded': sorted(set(m for run in runs for m in run['loaded']))}
+
+def CheckImports(modules:list = ['zcal', 'zcal.utils', 'zcal.grid', 'zcal.batch'], repeats:int = 3) -> list:
+    """ Import benchmarks of the light entry points, flagging any that load heavy backends """
+    results = [ImportTime(module, repeats) for module in modules]
+    for result in results:
+        result['ok'] = len(result['loaded']) == 0
+    return results
+
+# -=-=-=- ACCURACY -=-=-=-
+
+def Accuracy(truth:np.ndarray, fits:np.ndarray) -> dict:
+    """ Bias, scatter and 1σ coverage of (N, 3) [value, upper, lower] fits against their truths
+
+    the mocks follow the O3, O32 and Ne3O2 calibrations only, so objects with O2 / R23 are fit to calibrations
+    that disagree with their truths: this measures the mocks as much as the fitter (see Agreement) """
+    ok = fits[:, 0] != -999.0
+    if not np.any(ok):
+        return {'nfit': 0}
+    residual = fits[ok, 0] - truth[ok]
+    sigma = np.where(residual > 0, fits[ok, 2], fits[ok, 1])
+    return {'nfit': int(np.sum(ok)), 'bias': float(np.median(residual)), 'rms': float(np.sqrt(np.mean(residual ** 2))),
+            'coverage_1sigma': float(np.mean(np.abs(residual) <= sigma))}
+
+def Reference(scheme:str, mock:dict, dust:bool = True, n_oh:int = 800, n_ebv:int = 400) -> tuple:
+    """ Dense grid posterior summaries of mock galaxies, the same likelihood and prior every method should reproduce """
+    from zcal import batch
+    return batch.GridCatalogue(scheme, *[mock[line] for line in batch.lines], dust=dust, n_oh=n_oh, n_ebv=n_ebv,
+                               ebv_range=(0., zcal.options['ebv_max']))
+
+def Agreement(reference:np.ndarray, fits:np.ndarray) -> dict:
+    """ Offsets of (N, 3) [value, upper, lower] fits from the reference posterior's, and the ratio of their 1σ widths """
+    ok = (fits[:, 0] != -999.0) & (reference[:, 0] != -999.0)
+    if not np.any(ok):
+        return {'nfit': 0}
+    offset = np.abs(fits[ok, 0] - reference[ok, 0])
+    width = (fits[ok, 1] + fits[ok, 2]) / (reference[ok, 1] + reference[ok, 2])
+    return {'nfit': int(np.sum(ok)), 'median_offset': float(np.median(offset)), 'max_offset': float(np.max(offset)),
+            'median_width_ratio': float(np.median(width))}
+
+# -=-=-=- FIT BENCHMARKS -=-=-=-
+
+@contextlib.contextmanager
+def _Options(**overrides):
+    """ Temporarily overrides zcal.options (no plots or output written while benchmarking) """
+    saved = dict(zcal.options)
+    zcal.options.update(dict(corner_plots=False, save_pkl=False, output=None, cache_dir=None, checkpoint_dir=None), **overrides)
+    try:
+        yield zcal.options
+    finally:
+        zcal.options.clear()
+        zcal.options.update(saved)
+
+def FitLatency(schemes:list = ['sanders', 'nakajima', 'bian'], methods:list = ['dynesty', 'laplace', 'grid'],
+               n:int = 20, snr:float = 10., missing:dict = None, dust:bool = True, seed:int = 0) -> list:
+    """ Per-object latency of FitZg_DustCorrect / FitZg_NoDust for each scheme and method, with their agreement
+        with the dense grid posterior (and their accuracy against the mock truths) """
+    from zcal import fitting
+    results = []
+    for scheme in schemes:
+        mock = mocks.SyntheticGalaxies(scheme, n, snr, missing, dust=dust, seed=seed)
+        reference = Reference(scheme, mock, dust)
+        for method in methods:
+            times, oh, ebv = [], [], []
+            with _Options(method=method) as options:
+                for i in range(n):
+                    fluxes = [mock[line][i] for line in ('oiii', 'oii', 'hb', 'neiii')]
+                    rstate = np.random.default_rng(seed + i)
+                    start = time.perf_counter()
+                    if dust:
+                        fit = fitting.FitZg_DustCorrect(mock['ids'][i], scheme, *fluxes, rstate=rstate, options=options)
+                    else:
+                        fit = fitting.FitZg_NoDust(mock['ids'][i], scheme, *fluxes, rstate=rstate, options=options), np.full(3, np.nan)
+                    times.append(time.perf_counter() - start)
+                    oh.append(fit[0]), ebv.append(fit[1])
+            times = np.array(times)
+            results.append({'scheme': scheme, 'method': method, 'dust': dust, 'n': n, 'snr': snr, 'missing': missing,
+                            'median_s': float(np.median(times)), 'p95_s': float(np.percentile(times, 95)),
+                            'total_s': float(np.sum(times)),
+                            'logOHp12': Agreement(reference[0], np.array(oh)),
+                            'EBV': Agreement(reference[1], np.array(ebv)) if dust else None,
+                            'truth': {'logOHp12': Accuracy(mock['logOHp12'], np.array(oh)),
+                                      'EBV': Accuracy(mock['EBV'], np.array(ebv)) if dust else None}})
+    return results
+
+def Throughput(scheme:str = 'sanders', n:int = 32, workers:list = [1, 2, 4], dust:bool = True, method:str = 'dynesty',
+               seed:int = 0) -> list:
+    """ Catalogue throughput (objects per second) of batch.FitCatalogue against the number of workers """
+    from zcal import batch
+    mock = mocks.SyntheticGalaxies(scheme, n, dust=dust, seed=seed)
+    results = []
+    with _Options(method=method):
+        for nworkers in workers:
+            start = time.perf_counter()
+            batch.FitCatalogue(mock['ids'], scheme, mock['oiii'], mock['oii'], mock['hb'], mock['neiii'],
+                               dust=dust, nworkers=nworkers, seed=seed)
+            seconds = time.perf_counter() - start
+            results.append({'scheme': scheme, 'method': method, 'n': n, 'nworkers': nworkers,
+                            'seconds': seconds, 'objects_per_s': n / seconds})
+    return results
+
+# -=-=-=- SMOKE CHECKS -=-=-=-
+
+_plot_probe = """
+import os, glob, json, tempfile
+import zcal
+from zcal import mocks, {pool}
+zcal.Initialise('sanders')
+plot_dir = tempfile.mkdtemp()
+os.makedirs(f'{{plot_dir}}/corners')
+zcal.options.update(corner_plots='background', save_pkl=False, output=None, cache_dir=None, checkpoint_dir=None,
+                    plot_dir=plot_dir, res_dir=plot_dir, method='dynesty', sampler=dict(zcal.options['sampler'], nlive=50))
+mock = mocks.SyntheticGalaxies('sanders', {n}, snr=20.)
+{pool}.FitCatalogue(mock['ids'], 'sanders', mock['oiii'], mock['oii'], mock['hb'], mock['neiii'], nworkers=2{kwargs})
+print(json.dumps({{'plots': len(glob.glob(f'{{plot_dir}}/corners/*.png'))}}))
+"""
+
+def CheckBackgroundPlots(n:int = 4, timeout:float = 300.) -> list:
+    """ Catalogue fits with background corner plots on a process pool (in fresh interpreters),
+        flagging runs that hang or lose plots """
+    results = []
+    for pool, kwargs in [('batch', ''), ('workers', ', max_tasks=1')]:
+        start = time.perf_counter()
+        try:
+            out = subprocess.run([sys.executable, '-c', _plot_probe.format(pool=pool, n=n, kwargs=kwargs)],
+                                 env=_Env(), capture_output=True, text=True, check=True, timeout=timeout)
+            plots = json.loads(out.stdout.splitlines()[-1])['plots']
+        except subprocess.TimeoutExpired:
+            plots = None
+        results.append({'pool': pool, 'n': n, 'seconds': time.perf_counter() - start, 'plots': plots, 'ok': plots == n})
+    return results
+
+# -=-=-=- MICROBENCHMARKS -=-=-=-
+
+def _Time(func, repeats:int) -> float:
+    """ Best-of-three mean time of a call over repeats """
+    best = np.inf
+    for _ in range(3):
+        start = time.perf_counter()
+        for _ in range(repeats):
+            func()
+        best = min(best, (time.perf_counter() - start) / repeats)
+    return best
+
+def LogLMicro(schemes:list = ['sanders', 'nakajima', 'bian'], npoints:list = [1, 100, 10000], repeats:int = 200) -> list:
+    """ Time per likelihood call (and per point) of the batched likelihood, with and without dust """
+    from zcal import utils, fitting
+    results = []
+    for scheme in schemes:
+        mock = mocks.SyntheticGalaxies(scheme, 1)
+        obs = fitting.Observe(scheme, *[mock[line][0] for line in ('oiii', 'oii', 'hb', 'neiii')], nakajima=False)
+        S = utils.GetScheme(scheme)
+        coeffs = utils.CoefficientTable(S, obs.calibrations)
+        model_errs = np.array([S.errors[cal] for cal in obs.calibrations])
+        for dust in (False, True):
+            logl = fitting.LogLikelihood(obs, coeffs, model_errs, S.oh_to_x,
+                                         utils.Cardelli_k(list(S.wavelengths.values())) if dust else None)
+            for npts in npoints:
+                points = np.column_stack([np.full(npts, -4.), np.full(npts, 0.3)])
+                seconds = _Time(lambda: logl.batch(points), max(1, repeats // max(1, npts // 100)))
+                results.append({'scheme': scheme, 'dust': dust, 'npoints': npts,
+                                'call_s': seconds, 'per_point_s': seconds / npts})
+    return results
+
+def CardelliMicro(repeats:int = 2000) -> dict:
+    """ Cost of Cardelli_Attenuation at the line wavelengths against the cached kλ path """
+    from zcal import utils
+    wl = np.array(list(utils.GetScheme('sanders').wavelengths.values()))
+    return {'attenuation_s': _Time(lambda: utils.Cardelli_Attenuation(wl, 0.3), repeats),
+            'cached_k_s': _Time(lambda: utils.LineAttenuation(wl, 0.3), repeats)}
+
+# -=-=-=- SUITE -=-=-=-
+
+def RunSuite(quick:bool = False, seed:int = 0) -> dict:
+    """ Runs every benchmark, returning a JSON-serialisable report """
+    n = 5 if quick else 20
+    report = {'version': {'python': sys.version.split()[0], 'numpy': np.__version__},
+              'notes': 'latency logOHp12 / EBV compare each method with the dense grid posterior; the truth '
+                       'metrics also reflect mocks built from the O3, O32 and Ne3O2 calibrations only',
+              'imports': CheckImports(repeats=1 if quick else 3),
+              'loglikelihood': LogLMicro(repeats=20 if quick else 200),
+              'cardelli': CardelliMicro(200 if quick else 2000),
+              'latency': FitLatency(n=n, seed=seed) + FitLatency(n=n, seed=seed, dust=False, methods=['dynesty', 'quad', 'grid'])
+                         + FitLatency(n=n, seed=seed, snr=5., missing={'neiii': 0.5, 'oii': 0.2}, methods=['dynesty']),
+              'throughput': Throughput(n=2 * n, workers=[1, 2] if quick else [1, 2, 4], seed=seed)}
+    try:
+        import dynesty
+        report['version']['dynesty'] = dynesty.__version__
+    except ImportError:
+        pass
+    return report
+
+if __name__ == '__main__':
+    command = sys.argv[1] if len(sys.argv) > 1 else 'imports'
+    if command == 'imports':
+        results = CheckImports()
+        print(json.dumps(results, indent=2))
+        sys.exit(0 if all(result['ok'] for result in results) else 1)
+    elif command == 'plots':
+        results = CheckBackgroundPlots()
+        print(json.dumps(results, indent=2))
+        sys.exit(0 if all(result['ok'] for result in results) else 1)
+    elif command in ('all', 'quick'):
+        # python -m zcal.bench all [output.json]
+        report = RunSuite(quick=command == 'quick')
+        if len(sys.argv) > 2:
+            with open(sys.argv[2], 'w') as outfile:
+                json.dump(report, outfile, indent=2)
+        else:
+            print(json.dumps(report, indent=2))
@@ -0,0 +1,146 @@
+# imports
+import zcal
+from zcal import utils, stats
+import numpy as np
+import functools, hashlib, inspect, os, glob
+
+# options that do not change a fit's result (excluded from cache keys)
+ignored_options = {'verbose', 'corner_plots', 'save_pkl', 'res_dir', 'plot_dir', 'cache_dir', 'cache_max_bytes',
+                   'output', 'store_dir', 'store_samples', 'store_shard_size', 'checkpoint_dir', 'checkpoint_every',
+                   'stats', 'profile_dir'}
+
+# -=-=-=- KEYS -=-=-=-
+
+def _Update(h, value) -> None:
+    """ Feeds a (nested) value into a hash in a repr-independent way """
+    if isinstance(value, dict):
+        for key in sorted(value, key=str):
+            h.update(str(key).encode())
+            _Update(h, value[key])
+    elif isinstance(value, (list, tuple)):
+        h.update(f'[{len(value)}'.encode())
+        for v in value:
+            _Update(h, v)
+    elif isinstance(value, np.ndarray):
+        h.update(str((value.dtype, value.shape)).encode())
+        h.update(np.ascontiguousarray(value).tobytes())
+    elif callable(value):
+        h.update(getattr(value, '__qualname__', repr(value)).encode())
+    else:
+        h.update(repr(value).encode())
+
+def Hash(value) -> str:
+    """ Hex digest of a (nested) value, as hashed into cache keys """
+    h = hashlib.sha256()
+    _Update(h, value)
+    return h.hexdigest()
+
+def Fingerprint(scheme:str) -> str:
+    """ Short hash of a scheme's calibrations, errors, range, wavelengths and diagnostic conventions """
+    scheme = utils.GetScheme(scheme)
+    h = hashlib.sha256()
+    _Update(h, [scheme.name, dict(scheme.coefficients), dict(scheme.errors), scheme.range,
+                dict(scheme.wavelengths), scheme.oh_to_x, scheme.diagnostics, scheme.oiii_factor])
+    return h.hexdigest()[:12]
+
+def CacheKey(name:str, arguments:dict, options:dict) -> str:
+    """ Cache file name for a fit: scheme, calibration fingerprint and hash of all inputs, including the state of
+        an explicitly seeded random generator (entropy-seeded fits, rstate=None, are not reproducible anyway) """
+    scheme = utils.GetScheme(arguments['scheme'])
+    rstate = arguments.get('rstate')
+    rstate = rstate.bit_generator.state if isinstance(rstate, np.random.Generator) else rstate
+
+    h = hashlib.sha256()
+    _Update(h, [name, Fingerprint(scheme),
+                [np.asarray(arguments[line], dtype=float) for line in ('oiii', 'oii', 'hb', 'neiii')],
+                {key:value for key, value in arguments.items()
+                 if key not in ('id', 'scheme', 'oiii', 'oii', 'hb', 'neiii', 'rstate', 'options')},
+                rstate, {key:value for key, value in options.items() if key not in ignored_options}])
+    return f'{scheme.name}_{Fingerprint(scheme)}_{h.hexdigest()}'
+
+# -=-=-=- STORAGE -=-=-=-
+
+def Load(key:str, cache_dir:str):
+    """ Returns the cached result for a key (or None on a miss) """
+    path = os.path.join(cache_dir, f'{key}.npz')
+    try:
+        with np.load(path) as data:
+            result = [data[f'arr_{i}'] for i in range(len(data.files) - 1)]
+            single = bool(data['single'])
+        os.utime(path) # mark as recently used
+    except (FileNotFoundError, OSError, KeyError, ValueError):
+        return None
+    return result[0] if single else tuple(result)
+
+def Store(key:str, result, cache_dir:str, max_bytes:int = None) -> None:
+    """ Atomically writes a result to the cache, evicting least recently used entries beyond max_bytes """
+    os.makedirs(cache_dir, exist_ok=True)
+    single = not isinstance(result, tuple)
+    tmp = os.path.join(cache_dir, f'.{key}.{os.getpid()}.tmp.npz')
+    np.savez(tmp, *((result,) if single else result), single=single)
+    os.replace(tmp, os.path.join(cache_dir, f'{key}.npz'))
+    if max_bytes is not None:
+        Evict(cache_dir, max_bytes)
+
+def Evict(cache_dir:str, max_bytes:int) -> None:
+    """ Removes least recently used entries until the cache fits within max_bytes """
+    entries = []
+    for path in glob.glob(os.path.join(cache_dir, '*.npz')):
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, path))
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+
+def Invalidate(cache_dir:str, scheme:str = None, stale:bool = False) -> int:
+    """ Removes cached results (of one scheme, or only those whose calibrations have since changed) """
+    pattern = '*.npz' if scheme is None else f'{utils.GetScheme(scheme).name}_*.npz'
+    removed = 0
+    for path in glob.glob(os.path.join(cache_dir, pattern)):
+        name, fingerprint, _ = os.path.basename(path).rsplit('_', 2)
+        # schemes no longer registered (e.g. added in an earlier session) count as stale
+        if stale and name in utils.schemes and fingerprint == Fingerprint(name):
+            continue
+        os.remove(path)
+        removed += 1
+    return removed
+
+# -=-=-=- DECORATOR -=-=-=-
+
+def Cached(fit):
+    """ Wraps a FitZg_* method so unchanged inputs return the cached summaries (when options['cache_dir'] is set),
+        inside stats.Instrumented so a hit still leaves its own record """
+    signature = inspect.signature(fit)
+
+    @functools.wraps(fit)
+    def wrapper(*args, **kwargs):
+        bound = signature.bind(*args, **kwargs)
+        bound.apply_defaults()
+        options = zcal.options if bound.arguments.get('options') is None else bound.arguments['options']
+        if options.get('cache_dir') is None:
+            return fit(*args, **kwargs)
+
+        # key is built before fitting (hits are marked in the stats record of the fit)
+        record = stats.Current()
+        with stats.Stage(record, 'cache'):
+            key = CacheKey(fit.__name__, bound.arguments, options)
+            result = Load(key, options['cache_dir'])
+        if result is not None:
+            if record is not None:
+                record['cached'] = True
+            return result
+        result = fit(*args, **kwargs)
+        with stats.Stage(record, 'cache'):
+            Store(key, result, options['cache_dir'], options.get('cache_max_bytes'))
+        return result
+
+    return wrapper
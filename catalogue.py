@@ -0,0 +1,106 @@
+# imports
+import zcal
+from zcal import batch
+import numpy as np
+import os, csv, itertools
+
+# -=-=-=- STREAMING INPUT -=-=-=-
+
+def _Columns(id_col:str, names:dict) -> dict:
+    """ Input column of the id and of each line's value and error ({line} and {line}_err by default) """
+    names = {} if names is None else names
+    columns = {'id': names.get('id', id_col)}
+    for line in batch.lines:
+        columns[line] = names.get(line, line)
+        columns[f'{line}_err'] = names.get(f'{line}_err', f'{columns[line]}_err')
+    return columns
+
+def _Batch(table, columns:dict) -> dict:
+    """ Copies one slice of a table (structured array, FITS record or dict of columns) into fitting inputs """
+    chunk = {'id': np.asarray(table[columns['id']]).astype(str)}
+    for line in batch.lines:
+        chunk[line] = np.column_stack([np.asarray(table[columns[line]], dtype=float),
+                                       np.asarray(table[columns[f'{line}_err']], dtype=float)])
+    return chunk
+
+def _ReadNumpy(path:str, columns:dict, batch_size:int):
+    # memory-mapped, so only the current slice is ever read into memory
+    table = np.load(path, mmap_mode='r')
+    for start in range(0, len(table), batch_size):
+        yield _Batch(table[start:start + batch_size], columns)
+
+def _ReadCSV(path:str, columns:dict, batch_size:int):
+    with open(path, newline='') as infile:
+        reader = csv.DictReader(infile)
+        while True:
+            rows = list(itertools.islice(reader, batch_size))
+            if not rows:
+                break
+            yield _Batch({name: [row[name] for row in rows] for name in columns.values()}, columns)
+
+def _ReadFITS(path:str, columns:dict, batch_size:int, hdu:int = 1):
+    try:
+        from astropy.io import fits
+    except ImportError:
+        raise ImportError('reading FITS catalogues requires astropy (pip install astropy)')
+    with fits.open(path, memmap=True) as hdul:
+        table = hdul[hdu].data
+        for start in range(0, len(table), batch_size):
+            yield _Batch(table[start:start + batch_size], columns)
+
+def ReadBatches(path:str, batch_size:int = 1024, id_col:str = 'id', names:dict = None):
+    """ Yields fixed-size batches {'id', 'oiii', 'oii', 'hb', 'neiii'} from a .npy (structured), .csv or FITS catalogue """
+    columns = _Columns(id_col, names)
+    if path.endswith('.npy'):
+        return _ReadNumpy(path, columns, batch_size)
+    elif path.endswith('.csv'):
+        return _ReadCSV(path, columns, batch_size)
+    elif path.endswith(('.fits', '.fit', '.fits.gz')):
+        return _ReadFITS(path, columns, batch_size)
+    raise ValueError(f'unrecognised catalogue format ({path}), expected .npy, .csv or .fits')
+
+# -=-=-=- STREAMING OUTPUT -=-=-=-
+
+class SummaryWriter:
+    """ Appends batches of structured summaries (batch.result_dtype) to a CSV file as they are fitted """
+
+    def __init__(self, path:str, append:bool = False):
+        self.path = path
+        exists = append and os.path.exists(path) and os.path.getsize(path) > 0
+        self.file = open(path, 'a' if append else 'w', newline='')
+        self.writer = csv.writer(self.file)
+        if not exists:
+            self.writer.writerow([name for name, _ in batch.result_dtype])
+
+    def Write(self, results:np.ndarray) -> None:
+        self.writer.writerows(results.tolist())
+        self.file.flush()
+
+    def Close(self) -> None:
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.Close()
+
+def FitStream(path:str, scheme:str, out_path:str, batch_size:int = 1024, dust:bool = True, nworkers:int = None,
+              chunksize:int = 8, seed:int = None, id_col:str = 'id', names:dict = None) -> int:
+    """ Fits a catalogue batch by batch (one process pool for the whole run), writing summaries as each batch finishes """
+    nfit = 0
+    executor = None if (nworkers == 1 or zcal.options['method'] == 'grid') else batch.Executor(nworkers)
+    try:
+        with SummaryWriter(out_path) as writer:
+            for chunk in ReadBatches(path, batch_size, id_col, names):
+                # seeds follow each object's id, so runs are reproducible for any batch_size
+                results = batch.FitCatalogue(chunk['id'], scheme, chunk['oiii'], chunk['oii'], chunk['hb'], chunk['neiii'],
+                                             dust=dust, nworkers=nworkers, chunksize=chunksize, seed=seed, executor=executor)
+                writer.Write(results)
+                nfit += len(results)
+                if zcal.options['verbose']:
+                    print(f'-> [zcal]: {nfit} objects fitted.')
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    return nfit
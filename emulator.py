@@ -0,0 +1,186 @@
+# imports
+import zcal
+from zcal import utils, cache, batch
+import numpy as np
+import os, itertools
+from functools import lru_cache
+
+# line patterns tabulated by default (every other pattern falls back to a real fit)
+patterns = [('oiii', 'oii', 'hb', 'neiii'), ('oiii', 'oii', 'hb')]
+
+# table coordinates written by this version (tables of other layouts are not used)
+layout = 2
+
+# -=-=-=- TABLE COORDINATES -=-=-=-
+
+def _Reference(pattern:tuple) -> str:
+    return 'hb' if 'hb' in pattern else 'oii'
+
+def Coordinates(pattern:tuple, fluxes:dict) -> np.ndarray:
+    """ Table coordinates of (N, 2) line fluxes: log(line / reference) of each other line and the relative error
+        (1 / S/N) of every line, which is all the dust-corrected likelihood depends on """
+    ref = _Reference(pattern)
+    with np.errstate(all='ignore'):
+        ratios = [np.log10(fluxes[line][:, 0] / fluxes[ref][:, 0]) for line in pattern if line != ref]
+        errors = [fluxes[line][:, 1] / fluxes[line][:, 0] for line in pattern]
+    return np.column_stack(ratios + errors)
+
+def Pattern(fluxes:dict) -> np.ndarray:
+    """ Line pattern (tuple of present lines) of each object """
+    present = np.column_stack([fluxes[line][:, 1] >= 0 for line in batch.lines])
+    return [tuple(line for line, p in zip(batch.lines, row) if p) for row in present]
+
+def _DefaultAxes(scheme:str, pattern:tuple, n_ratio:int, min_snr:float, n_err:int, oh_range:tuple, ebv_range:tuple) -> list:
+    """ Ratio axes spanning the calibrations over oh_range and ebv_range (padded by 0.1 dex), and relative error
+        axes from 0 to 1 / min_snr (linear in the error, along which posteriors vary smoothly) """
+    from zcal import mocks
+    mock = mocks.SyntheticGalaxies(scheme, 4000, snr=1e8, oh_range=oh_range, ebv_range=ebv_range, seed=0)
+    coords = Coordinates(pattern, mock)[:, :len(pattern) - 1]
+    axes = [np.linspace(np.nanmin(c) - 0.1, np.nanmax(c) + 0.1, n_ratio) for c in coords.T]
+    return axes + [np.linspace(0., 1. / min_snr, n_err) for _ in pattern]
+
+# -=-=-=- EMULATOR -=-=-=-
+
+class Emulator:
+    """ Lookup table of dust-corrected posterior quantiles over binned line ratios and line S/N, per line pattern """
+
+    def __init__(self, scheme:str, tables:dict, fingerprint:str = None, ebv_max:float = 2.):
+        self.scheme = utils.GetScheme(scheme).name
+        self.fingerprint = cache.Fingerprint(self.scheme) if fingerprint is None else fingerprint
+        self.tables = tables # {pattern: (axes, values (..., 7): logOHp12[3], EBV[3], ok)}
+        self.ebv_max = ebv_max # upper bound of the E(B-V) prior the table was built with
+
+    def Applies(self, scheme:str, ebv_max:float) -> bool:
+        """ Whether the table was built for this scheme (with its current calibrations) and E(B-V) prior """
+        scheme = utils.GetScheme(scheme)
+        return scheme.name == self.scheme and cache.Fingerprint(scheme) == self.fingerprint and ebv_max == self.ebv_max
+
+    def _Interpolate(self, pattern:tuple, coords:np.ndarray) -> np.ndarray:
+        """ Multilinear interpolation of a pattern's table at (N, ndim) coordinates (NaN outside the table) """
+        axes, values = self.tables[pattern]
+        idx, frac = [], []
+        for axis, c in zip(axes, coords.T):
+            i = np.clip(np.searchsorted(axis, c, side='right') - 1, 0, len(axis) - 2)
+            idx.append(i)
+            frac.append(np.where((c >= axis[0]) & (c <= axis[-1]), (c - axis[i]) / (axis[i+1] - axis[i]), np.nan))
+        idx, frac = np.column_stack(idx), np.column_stack(frac)
+
+        # weighted sum over the 2^ndim corners of each cell, shape (N, corners, values)
+        corners = np.array(list(itertools.product((0, 1), repeat=len(axes))))
+        weights = np.prod(np.where(corners, frac[:, None, :], 1. - frac[:, None, :]), axis=2)
+        return np.einsum('nc,ncv->nv', weights, values[tuple(np.moveaxis(idx[:, None, :] + corners, -1, 0))])
+
+    def Query(self, oiii:np.ndarray, oii:np.ndarray, hb:np.ndarray, neiii:np.ndarray) -> tuple:
+        """ Interpolated (N, 3) logOHp12 and EBVs summaries, and whether each object is inside the table's coverage and tolerance """
+        fluxes = {line: np.atleast_2d(np.asarray(f, dtype=float)) for line, f in zip(batch.lines, (oiii, oii, hb, neiii))}
+        n = len(fluxes['oiii'])
+        logOHp12, EBVs, ok = np.full((n, 3), np.nan), np.full((n, 3), np.nan), np.zeros(n, dtype=bool)
+
+        objects = Pattern(fluxes)
+        for pattern in set(objects) & set(self.tables):
+            rows = np.flatnonzero([p == pattern for p in objects])
+            values = self._Interpolate(pattern, Coordinates(pattern, {line: f[rows] for line, f in fluxes.items()}))
+            # every corner of the cell must be within tolerance (interpolated flag of exactly one)
+            inside = np.all(np.isfinite(values), axis=1) & (values[:, 6] > 1 - 1e-9)
+            logOHp12[rows], EBVs[rows], ok[rows] = values[:, 0:3], values[:, 3:6], inside
+        return logOHp12, EBVs, ok
+
+    def Fit(self, ids:np.ndarray, oiii:np.ndarray, oii:np.ndarray, hb:np.ndarray, neiii:np.ndarray, **kwargs) -> np.ndarray:
+        """ Catalogue summaries (batch.result_dtype) from the table, running real fits only where it does not apply """
+        ids = np.atleast_1d(ids).astype(str)
+        logOHp12, EBVs, ok = self.Query(oiii, oii, hb, neiii)
+        # a table built with other calibrations or E(B-V) prior is not used at all
+        if not self.Applies(self.scheme, zcal.options['ebv_max']):
+            ok[:] = False
+
+        if not np.all(ok):
+            rest = np.flatnonzero(~ok)
+            fits = batch.FitCatalogue(ids[rest], self.scheme, *[np.asarray(f, dtype=float).reshape(len(ids), 2)[rest]
+                                                              for f in (oiii, oii, hb, neiii)], dust=True, **kwargs)
+            logOHp12[rest] = np.column_stack([fits['logOHp12'], fits['logOHp12_up'], fits['logOHp12_lo']])
+            EBVs[rest] = np.column_stack([fits['EBV'], fits['EBV_up'], fits['EBV_lo']])
+
+        results = np.zeros(len(ids), dtype=batch.result_dtype)
+        results['id'] = ids
+        for i, name in enumerate(['logOHp12', 'logOHp12_up', 'logOHp12_lo']):
+            results[name] = logOHp12[:, i]
+        for i, name in enumerate(['EBV', 'EBV_up', 'EBV_lo']):
+            results[name] = EBVs[:, i]
+        return results
+
+    def Save(self, path:str) -> None:
+        """ Writes the tables to a single .npz (atomically) """
+        arrays = {'scheme': self.scheme, 'fingerprint': self.fingerprint, 'ebv_max': self.ebv_max, 'layout': layout}
+        for i, (pattern, (axes, values)) in enumerate(self.tables.items()):
+            arrays[f'pattern_{i}'] = np.array(pattern)
+            arrays[f'values_{i}'] = values
+            for j, axis in enumerate(axes):
+                arrays[f'axis_{i}_{j}'] = axis
+        tmp = f'{path}.{os.getpid()}.tmp.npz'
+        np.savez(tmp, **arrays)
+        os.replace(tmp, path)
+
+def Build(scheme:str, patterns:list = patterns, n_ratio:int = 16, min_snr:float = 3., n_err:int = 3,
+          oh_range:tuple = (7.5, 8.8), ebv_range:tuple = (0., 1.), tol:float = 0.03, axes:dict = None,
+          n_oh:int = 200, n_ebv:int = 100, ebv_max:float = None) -> Emulator:
+    """ Tabulates grid posteriors (batch.GridCatalogue, i.e. the dust-corrected likelihood with an E(B-V) prior
+        up to ebv_max, options['ebv_max'] by default) at every table node, with ratio axes covering galaxies
+        in oh_range and ebv_range, and an error axis per line covering S/N above min_snr
+
+    nodes where linear interpolation would err by more than tol (e.g. across branches) are flagged,
+    so queries in the cells around them fall back to a real fit """
+    scheme = utils.GetScheme(scheme)
+    ebv_max = zcal.options['ebv_max'] if ebv_max is None else ebv_max
+    axes = {} if axes is None else axes
+    tables = {}
+    for pattern in map(tuple, patterns):
+        grid_axes = axes.get(pattern) or _DefaultAxes(scheme.name, pattern, n_ratio, min_snr, n_err, oh_range, ebv_range)
+        ref = _Reference(pattern)
+
+        # line fluxes (relative to the reference line) and errors at every node, in Coordinates order
+        nodes = np.array(list(itertools.product(*grid_axes)))
+        others = [line for line in pattern if line != ref]
+        ratios = dict(zip(others, nodes[:, :len(others)].T), **{ref: np.zeros(len(nodes))})
+        fluxes = {line: np.full((len(nodes), 2), -999.) for line in batch.lines}
+        for line, error in zip(pattern, nodes[:, len(others):].T):
+            flux = np.power(10, ratios[line])
+            fluxes[line] = np.column_stack([flux, flux * error])
+
+        logOHp12, EBVs = batch.GridCatalogue(scheme, *[fluxes[line] for line in batch.lines], dust=True,
+                                             n_oh=n_oh, n_ebv=n_ebv, ebv_range=(0., ebv_max))
+
+        # tolerance flags: the linear interpolation error at cell midpoints (a quarter of the second
+        # difference) of the median log(O/H) and E(B-V), flagging the failing node (and so both cells around it)
+        shape = tuple(len(a) for a in grid_axes)
+        medians = [logOHp12[:, 0].reshape(shape), EBVs[:, 0].reshape(shape)]
+        ok = np.isfinite(medians[0]) & (medians[0] != -999.0)
+        for median in medians:
+            for axis in range(len(shape)):
+                error = np.abs(np.diff(median, n=2, axis=axis)) / 4. > tol
+                ok &= ~np.pad(error, [(1, 1) if a == axis else (0, 0) for a in range(len(shape))])
+
+        values = np.concatenate([logOHp12, EBVs, ok.reshape(-1, 1)], axis=1).reshape(shape + (7,))
+        tables[pattern] = (grid_axes, values)
+    return Emulator(scheme.name, tables, ebv_max=ebv_max)
+
+@lru_cache(maxsize=8)
+def Load(path:str) -> Emulator:
+    """ Reads (and caches) an emulator written by Emulator.Save """
+    with np.load(path) as data:
+        tables = {}
+        for i in itertools.count():
+            if f'pattern_{i}' not in data:
+                break
+            naxes = len([key for key in data.files if key.startswith(f'axis_{i}_')])
+            tables[tuple(str(line) for line in data[f'pattern_{i}'])] = \
+                ([data[f'axis_{i}_{j}'] for j in range(naxes)], data[f'values_{i}'])
+        # tables written before the prior was recorded used GridCatalogue's (0, 2)
+        emulator = Emulator(str(data['scheme']), tables, str(data['fingerprint']),
+                            float(data['ebv_max']) if 'ebv_max' in data else 2.)
+        # older tables binned every line at one mean S/N, so none of their cells apply
+        if (int(data['layout']) if 'layout' in data else 1) != layout:
+            print(f'-> [zcal]: emulator {path} uses an older table layout and needs rebuilding (fits will not use it).')
+            emulator.tables = {}
+    if emulator.fingerprint != cache.Fingerprint(emulator.scheme):
+        print(f'-> [zcal]: emulator {path} was built with different {emulator.scheme} calibrations (fits will not use it).')
+    return emulator
@@ -1,132 +1,412 @@
 # imports
 import zcal
-from zcal import utils
+from zcal import utils, grid, cache, store, plotting, stats
 import numpy as np
-import scipy.stats as stats
-import dynesty, pickle
-from dynesty import utils as dyfunc
-from dynesty import plotting as dyplot
-from uncertainties import ufloat, unumpy as unp
-from uncertainties.umath import log10 as ulog10
-
-# main method
-def FitZg_DustCorrect(id:str, scheme:str, oiii:np.ndarray, oii:np.ndarray, hb:np.ndarray, neiii:np.ndarray, correct:bool = True) -> np.ndarray:
-    
-    # initialise parameters
-    utils.SetCalibration(scheme)
-
-    # Generate Cardelli Grid ()
-    cardelli_wl = np.linspace(0.3, 0.6, 1000)
-
-    def logl(u:tuple) -> float:
-        
-        # unpack parameters
-        oh, ebv = u
-        
-        #  convert x into correct form for calibration
-        x = zcal.options['oh_to_x'](oh)
-    
-        if correct:
-            # for each line, work out correction factors
-            Aλ = utils.Cardelli_Attenuation(cardelli_wl, ebv)
-            corrections = [utils.DustCorrect(zcal.wavelengths[key], wl_grid=cardelli_wl, Aλ=Aλ) for key in zcal.wavelengths]
+import os, glob, time, pickle, json, warnings
+from typing import NamedTuple
+
+# -=-=-=- OBSERVATION PREPROCESSING -=-=-=-
+
+# diagnostic ordering (line columns follow zcal.wavelengths: oiii5007, oii, hbeta, neiii)
+diagnostics = ['O3', 'O2', 'R23', 'O32', 'Ne3O2']
+
+class Observation(NamedTuple):
+    """ Line fluxes and active diagnostics of a single object, computed once per fit """
+    valid: bool
+    calibrations: tuple
+    flux: np.ndarray
+    flux_err: np.ndarray
+    num: np.ndarray
+    den: np.ndarray
+    y: np.ndarray
+    yerr: np.ndarray
+
+def LineFluxes(oiii:np.ndarray, oii:np.ndarray, hb:np.ndarray, neiii:np.ndarray) -> tuple:
+    """ Stacks (..., 2) line measurements into (..., 4) fluxes and errors, flagging missing lines with -999 """
+    lines = np.stack([oiii, oii, hb, neiii], axis=-2).astype(float)
+    present = lines[..., 1] >= 0.
+    flux = np.where(present, lines[..., 0], -999.0)
+    flux_err = np.where(present, lines[..., 1], 0.)
+    return flux, flux_err
+
+def RatioWeights(scheme:str, nakajima:bool = True) -> tuple:
+    """ Numerator / denominator line weights of each diagnostic, shape (5, 4) (nakajima: use the scheme's own [OIII]
+        convention, e.g. nakajima's 5007 only, rather than the full doublet) """
+
+    # [OIII] doublet conversion (R23 always uses the full doublet)
+    factor = utils.GetScheme(scheme).oiii_factor if nakajima else (4/3)
+
+    num = np.array([[factor, 0., 0., 0.],  # O3
+                    [0.,     1., 0., 0.],  # O2
+                    [4/3,    1., 0., 0.],  # R23
+                    [factor, 0., 0., 0.],  # O32
+                    [0.,     0., 0., 1.]]) # Ne3O2
+    den = np.array([[0., 0., 1., 0.],
+                    [0., 0., 1., 0.],
+                    [0., 0., 1., 0.],
+                    [0., 1., 0., 0.],
+                    [0., 1., 0., 0.]])
+    return num, den
+
+def DiagnosticMask(scheme:str, flux:np.ndarray) -> tuple:
+    """ Diagnostics available for (..., 4) fluxes and calibrated by the scheme, shape (..., 5), and whether each object can be fit """
+    calibrated = np.array([cal in utils.GetScheme(scheme).diagnostics for cal in diagnostics])
+    has_oiii, has_oii, has_hb, has_neiii = np.moveaxis(flux > 0, -1, 0)
+    mask = np.stack([has_oiii & has_hb,
+                     has_oii & has_hb,
+                     has_oiii & has_oii & has_hb,
+                     has_oiii & has_oii,
+                     has_neiii & has_oii], axis=-1) & calibrated
+    valid = np.minimum(flux[..., 0], flux[..., 1]) >= 0
+    return mask, valid
+
+def Observe(scheme:str, oiii:np.ndarray, oii:np.ndarray, hb:np.ndarray, neiii:np.ndarray, nakajima:bool = True) -> Observation:
+    """ Builds the diagnostic vector, its uncertainties and the calibration mask for an object """
+
+    flux, flux_err = LineFluxes(oiii, oii, hb, neiii)
+    num, den = RatioWeights(scheme, nakajima)
+    mask, valid = DiagnosticMask(scheme, flux)
+
+    obs = Observation(valid = bool(valid),
+                      calibrations = tuple(np.array(diagnostics)[mask]),
+                      flux = flux, flux_err = flux_err,
+                      num = num[mask], den = den[mask],
+                      y = None, yerr = None)
+    y, yerr = LogRatios(obs)
+    return obs._replace(y=y, yerr=yerr)
+
+def LogRatios(obs:Observation, corrections:np.ndarray = None) -> tuple:
+    """ Returns the log line ratios (and uncertainties) of the active diagnostics """
+    if corrections is None:
+        flux, flux_err = obs.flux, obs.flux_err
+    else:
+        flux, flux_err = obs.flux * corrections, obs.flux_err * corrections
+    num, den = flux @ obs.num.T, flux @ obs.den.T
+    num_var, den_var = flux_err ** 2 @ obs.num.T ** 2, flux_err ** 2 @ obs.den.T ** 2
+    y = np.log10(num / den)
+    yerr = np.sqrt(num_var / num ** 2 + den_var / den ** 2) / np.log(10)
+    return y, yerr
+
+def InitialGuesses(scheme:str, obs:Observation) -> np.ndarray:
+    """ Candidate log(O/H) on every branch of each active calibration, from its cached inverse table """
+    guesses = [utils.Invert(scheme, cal, y) for cal, y in zip(obs.calibrations, obs.y)]
+    guesses = np.concatenate(guesses) if guesses else np.zeros(0)
+    return np.unique(guesses[np.isfinite(guesses)])
+
+# -=-=-=- OUTPUT -=-=-=-
+
+def SaveResults(name:str, id:str, scheme:utils.CalibrationScheme, results, logOHp12:np.ndarray, EBVs:np.ndarray,
+                options:dict, rstate:np.random.Generator = None, settings:dict = None) -> None:
+    """ Writes a fit's sampler output (and the sampler settings used) to the configured backend (options['output']: 'pickle', 'store' or None) """
+    if options['output'] == 'pickle' and options['save_pkl']:
+        path = f'{options["res_dir"]}/samplers/{name}.pkl'
+        _Pickle(path, results)
+        # adaptive settings differ per object, so they are kept next to the sampler output
+        if settings is not None and settings['adaptive']:
+            with open(f'{path[:-4]}.settings.json', 'w') as outfile:
+                json.dump(settings, outfile)
+    elif options['output'] == 'store':
+        store.Append(options['store_dir'], id, scheme.name, results, logOHp12, EBVs,
+                     nsamples=options['store_samples'], shard_size=options['store_shard_size'], rstate=rstate,
+                     settings=settings)
+
+def SaveSummary(method:str, id:str, scheme:utils.CalibrationScheme, post:dict, options:dict,
+                rstate:np.random.Generator = None) -> None:
+    """ Writes the posterior of a fit without a sampler (a grid / quad / Laplace posterior dict, or just the logOHp12
+        and EBV summaries) to the configured backend, with samples of grid and quadrature posteriors in stores """
+    settings = dict(options.get(method, {}), method=method)
+    if options['output'] == 'pickle' and options['save_pkl']:
+        _Pickle(f'{options["res_dir"]}/samplers/{id}_{scheme.name}_{method}.pkl', dict(post, settings=settings))
+    elif options['output'] == 'store':
+        # weighted posterior nodes, as (12+log(O/H), E(B-V)) (E(B-V) is NaN for fits without dust)
+        nodes, weights = None, None
+        if 'posterior' in post:
+            OH, EBV = np.meshgrid(post['oh'], post['ebv'], indexing='ij')
+            EBV = EBV if np.all(np.isfinite(post['EBV'])) else np.full_like(EBV, np.nan)
+            nodes, weights = np.column_stack([OH.ravel(), EBV.ravel()]), post['posterior'].ravel()
+        elif 'p_oh' in post:
+            nodes, weights = np.column_stack([post['oh'], np.full(len(post['oh']), np.nan)]), post['p_oh']
+        store.AppendSummary(options['store_dir'], id, scheme.name, post['logOHp12'], post.get('EBV', np.full(3, np.nan)),
+                            nodes, weights, post.get('logz', np.nan), nsamples=options['store_samples'],
+                            shard_size=options['store_shard_size'], rstate=rstate, settings=settings)
+
+def _Pickle(path:str, value) -> None:
+    # written atomically, so an interrupted run never leaves a truncated pickle
+    with open(f'{path}.{os.getpid()}.tmp', 'wb') as outfile:
+        pickle.dump(value, outfile)
+    os.replace(f'{path}.{os.getpid()}.tmp', path)
+
+# -=-=-=- VECTORISED LIKELIHOOD -=-=-=-
+
+def BatchLogL(points:np.ndarray, obs:Observation, coeffs:np.ndarray, model_errs:np.ndarray, oh_to_x, k_lines:np.ndarray = None) -> np.ndarray:
+    """ Log-likelihood of an (N, ndim) array of (log O/H[, E(B-V)]) points, returning N values """
+
+    # evaluate all active calibrations at once
+    points = np.atleast_2d(points)
+    model = utils.Horner(coeffs, oh_to_x(points[:, 0]))
+
+    # observed ratios, corrected for dust if kλ provided
+    if k_lines is None:
+        y, yerr = obs.y, obs.yerr
+    else:
+        y, yerr = LogRatios(obs, np.power(10, 0.4 * points[:, 1:2] * k_lines))
+
+    return -0.5 * np.sum(
+        (np.power(model - y, 2) / (yerr ** 2 + model_errs ** 2)) + 2 * np.log(yerr + model_errs), axis=-1
+    )
+
+class BatchPool:
+    """ dynesty-compatible pool that scores batches of likelihood calls in a single vectorised call """
+
+    size = 1
+
+    def __init__(self, logl_batch):
+        self.logl_batch = logl_batch
+
+    def map(self, func, iterable):
+        from dynesty import utils as dyfunc
+        if isinstance(func, dyfunc.LogLikelihood):
+            return [dyfunc.LoglOutput(v, func.blob) for v in self.logl_batch(np.asarray(list(iterable)))]
+        return map(func, iterable)
+
+class ProcessBatchPool:
+    """ dynesty-compatible pool that splits each likelihood batch (and queued proposals) across worker processes """
+
+    def __init__(self, logl, nworkers:int):
+        import multiprocessing
+        self.logl = logl
+        self.size = nworkers
+        self.pool = multiprocessing.Pool(nworkers)
+
+        # workers score without a stats record (batched calls are counted here, calls made inside queued proposals are not)
+        self.worker_logl = LogLikelihood(logl.obs, logl.coeffs, logl.model_errs, logl.oh_to_x, logl.k_lines)
+
+    def map(self, func, iterable):
+        from dynesty import utils as dyfunc
+        if not isinstance(func, dyfunc.LogLikelihood):
+            return self.pool.map(func, iterable)
+        points = np.asarray(list(iterable))
+        start = time.perf_counter()
+        logl = np.concatenate(self.pool.map(self.worker_logl.batch, np.array_split(points, min(self.size, len(points)))))
+        if self.logl.record is not None:
+            stats.CountLogL(self.logl.record, len(logl), time.perf_counter() - start)
+        return [dyfunc.LoglOutput(v, func.blob) for v in logl]
+
+    def close(self) -> None:
+        self.pool.close()
+        self.pool.join()
+
+class LogLikelihood:
+    """ Picklable log-likelihood of one object (so samplers can be checkpointed and sent to workers) """
+
+    def __init__(self, obs:Observation, coeffs:np.ndarray, model_errs:np.ndarray, oh_to_x, k_lines:np.ndarray = None,
+                 record:dict = None):
+        self.obs = obs
+        self.coeffs = coeffs
+        self.model_errs = model_errs
+        self.oh_to_x = oh_to_x
+        self.k_lines = k_lines
+        self.record = record # stats record (counts and times calls when set)
+
+    def batch(self, points:np.ndarray) -> np.ndarray:
+        if self.record is None:
+            return BatchLogL(points, self.obs, self.coeffs, self.model_errs, self.oh_to_x, self.k_lines)
+        start = time.perf_counter()
+        logl = BatchLogL(points, self.obs, self.coeffs, self.model_errs, self.oh_to_x, self.k_lines)
+        stats.CountLogL(self.record, len(logl), time.perf_counter() - start)
+        return logl
+
+    def __call__(self, u:tuple) -> float:
+        return self.batch(u)[0]
+
+class PriorTransform:
+    """ Picklable prior transform: uniform log O/H over the scheme range (and E(B-V) over [0, ebv_max]) """
+
+    def __init__(self, oh_range:tuple, ebv_max:float = None):
+        self.oh_range = tuple(oh_range)
+        self.ebv_max = ebv_max
+
+    def __call__(self, p:tuple) -> tuple:
+        pOH = (self.oh_range[0] - 12.) + (p[0] * (self.oh_range[1] - self.oh_range[0]))
+        if self.ebv_max is None:
+            return np.array([pOH])
+        return pOH, self.ebv_max * p[1]
+
+def SamplerSettings(obs:Observation, settings:dict) -> dict:
+    """ Sampler configuration of one object: options['sampler'] as given, or (if adaptive) scaled
+        by the number of available diagnostics and their S/N """
+    if not settings['adaptive']:
+        return {'adaptive': False, 'nlive': settings['nlive'], 'bound': 'multi', 'dlogz': None, 'maxcall': None, 'tol': None}
+
+    # information content: diagnostics x log(ratio S/N), clipped to 3 < S/N < 100
+    ndiag = len(obs.calibrations)
+    snr = float(np.median(1. / (np.log(10) * obs.yerr))) if ndiag else 0.
+    info = ndiag * np.clip(np.log10(max(snr, 1.)), 0.5, 2.)
+
+    # fewer live points and looser stopping for weakly constrained objects, which may also be
+    # multimodal (separate calibration branches) so keep multi-ellipsoid bounds for them
+    nlive = int(min(settings['nlive'], max(100, 50 * info)))
+    return {'adaptive': True, 'nlive': nlive, 'bound': 'multi' if ndiag <= 2 else 'single',
+            'dlogz': 1.0 if info < 2 else 0.5, 'maxcall': 200 * nlive, 'tol': settings['tol'],
+            'ndiag': ndiag, 'snr': snr}
+
+def _RunStable(sampler, settings:dict, run:dict) -> None:
+    """ Runs a static sampler in blocks of nlive iterations, stopping once the 16/50/84 log(O/H) quantiles of the
+        dead points move by less than settings['tol'] over two consecutive blocks (or dlogz / maxcall is reached) """
+    from dynesty import utils as dyfunc
+    ncall, previous, stable = sampler.ncall, None, 0
+
+    # blocks stopped by maxiter (not dlogz) are expected here, so dynesty's warning is silenced
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        while stable < 2:
+            it = sampler.it
+            sampler.run_nested(maxiter=settings['nlive'], maxcall=settings['maxcall'] - (sampler.ncall - ncall),
+                               dlogz=settings['dlogz'], add_live=False, **run)
+            run.pop('resume', None)
+            if sampler.it - it < settings['nlive'] or sampler.ncall - ncall >= settings['maxcall']:
+                break
+            results = sampler.results
+            quantiles = np.array(dyfunc.quantile(results['samples'][:, 0], [0.16, 0.50, 0.84],
+                                                 weights=np.exp(results['logwt'] - results['logz'][-1])))
+            stable = stable + 1 if previous is not None and np.max(np.abs(quantiles - previous)) < settings['tol'] else 0
+            previous = quantiles
+
+        # final block adds the live points to the run
+        sampler.run_nested(maxiter=0, dlogz=settings['dlogz'], **run)
+
+def RunSampler(name:str, logl:LogLikelihood, ptform:PriorTransform, ndim:int, options:dict,
+               rstate:np.random.Generator = None, settings:dict = None):
+    """ Runs dynesty with options['sampler'] (static or dynamic, optionally across a process pool) and the object's
+        SamplerSettings, checkpointing to (and resuming from) {checkpoint_dir}/{name}_{inputs}.save if options['checkpoint_dir'] is set """
+    import dynesty
+
+    sampler_options = options['sampler']
+    settings = SamplerSettings(logl.obs, sampler_options) if settings is None else settings
+    Sampler = dynesty.DynamicNestedSampler if sampler_options['dynamic'] else dynesty.NestedSampler
+    nworkers = sampler_options['pool'] or 1
+    pool = BatchPool(logl.batch) if nworkers == 1 else ProcessBatchPool(logl, nworkers)
+
+    # the dynamic sampler weights its extra batches entirely towards the posterior (not the evidence)
+    run = {'print_progress': options['verbose']}
+    if sampler_options['dynamic']:
+        run.update(nlive_init=settings['nlive'], maxcall=settings['maxcall'], wt_kwargs={'pfrac': 1.0})
+
+    # checkpoints are named by a hash of everything the fit depends on, so one made for other fluxes,
+    # calibrations, priors or sampler settings is never resumed (and is removed)
+    checkpoint_dir = options.get('checkpoint_dir')
+    checkpoint = None
+    if checkpoint_dir is not None:
+        inputs = cache.Hash([logl.obs, logl.coeffs, logl.model_errs, logl.oh_to_x, logl.k_lines,
+                             ptform.oh_range, ptform.ebv_max, ndim, settings, sampler_options])[:16]
+        checkpoint = f'{checkpoint_dir}/{name}_{inputs}.save'
+        os.makedirs(checkpoint_dir, exist_ok=True)
+        for stale in glob.glob(f'{glob.escape(checkpoint_dir)}/{glob.escape(name)}_{"[0-9a-f]" * 16}.save'):
+            if stale != checkpoint:
+                os.remove(stale)
+        run.update(checkpoint_file=checkpoint, checkpoint_every=options['checkpoint_every'])
+
+    try:
+        # resume an interrupted fit if a checkpoint exists
+        if checkpoint is not None and os.path.exists(checkpoint):
+            if options['verbose']:
+                print(f'-> [zcal]: resuming {name} from checkpoint.')
+            sampler = Sampler.restore(checkpoint, pool=pool)
+            run['resume'] = True
         else:
-            corrections = np.ones(len(zcal.wavelengths), dtype=float)
-
-        # generate ufloats for objects
-        if oiii[1] >= 0.:
-            oiiic = ufloat((4/3)*oiii[0]*corrections[0], (4/3)*oiii[1]*corrections[0])
+            sampler = Sampler(loglikelihood = logl, prior_transform = ptform,
+                              ndim = ndim, nlive = settings['nlive'], bound = settings['bound'], bootstrap = 0,
+                              pool = pool, queue_size = sampler_options['queue_size'], rstate = rstate)
+
+        # quantile-stability stopping applies to the static sampler
+        if settings['tol'] is not None and not sampler_options['dynamic']:
+            _RunStable(sampler, settings, run)
+        elif sampler_options['dynamic']:
+            sampler.run_nested(**run)
         else:
-            oiiic = ufloat(-999.0, 0.)
+            sampler.run_nested(maxcall=settings['maxcall'], dlogz=settings['dlogz'], **run)
+    finally:
+        if nworkers > 1:
+            pool.close()
 
-        if oii[1] >= 0.:
-            oiic = ufloat(oii[0]*corrections[1], oii[1]*corrections[1])
-        else:
-            oiic = ufloat(-999.0, 0.)
+    # finished fits don't need their checkpoint
+    results = sampler.results
+    if checkpoint is not None and os.path.exists(checkpoint):
+        os.remove(checkpoint)
+    return results
 
-        if hb[1] >= 0.:
-            hbc = ufloat(hb[0]*corrections[2], hb[1]*corrections[2])
-        else:
-            hbc = ufloat(-999.0, 0.)
+# methods of the dust-corrected fit ('quad' and 'mc' are 1D, no-dust only)
+dust_methods = ('dynesty', 'grid', 'laplace')
 
-        if neiii[1] >= 0.:
-            neiiic = ufloat(neiii[0]*corrections[3], neiii[1]*corrections[3])
-        else:
-            neiiic = ufloat(-999.0, 0.0)
+def CheckMethod(options:dict, dust:bool = True) -> None:
+    """ Raises a ValueError for a method that cannot run this fit (rather than silently sampling instead) """
+    if dust and options['method'] not in dust_methods:
+        raise ValueError(f"method {options['method']} does not fit dust (use one of {', '.join(dust_methods)})")
 
-        if min(oiiic.n, oiic.n) < 0:
+# main method
+@stats.Instrumented
+@cache.Cached
+def FitZg_DustCorrect(id:str, scheme:str, oiii:np.ndarray, oii:np.ndarray, hb:np.ndarray, neiii:np.ndarray, correct:bool = True, rstate:np.random.Generator = None, options:dict = None) -> np.ndarray:
+    
+    # calibration scheme and runtime options
+    scheme = utils.GetScheme(scheme)
+    options = zcal.options if options is None else options
+    record = stats.Current()
+    CheckMethod(options)
+
+    # precompute observed ratios and active calibrations
+    with stats.Stage(record, 'preprocess'):
+        obs = Observe(scheme.name, oiii, oii, hb, neiii, nakajima=False)
+        if not obs.valid:
             return np.ones(3) * -999.0, np.ones(3) * -999.0
- 
-        # set up arrays
-        y, yerr, calibrations = [], [], []
-
-        # o3
-        if min(oiiic.n, hbc.n) > 0:
-            o3 = unp.log10(oiiic / hbc)
-            y.append(unp.nominal_values(o3))
-            yerr.append(unp.std_devs(o3))
-            calibrations.append('O3')
-
-        # o2
-        if (min(oiic.n, hbc.n) > 0) & (scheme != 'bian'):
-            o2 = unp.log10(oiic / hbc)
-            y.append(unp.nominal_values(o2))
-            yerr.append(unp.std_devs(o2))
-            calibrations.append('O2')
-
-        # r23
-        if (min(oiiic.n, oiic.n, hbc.n) > 0) & (scheme != 'bian'):
-            r23 = unp.log10((oiiic + oiic) / hbc)
-            y.append(unp.nominal_values(r23))
-            yerr.append(unp.std_devs(r23))
-            calibrations.append('R23')
-            
-        # o32
-        if min(oiiic.n, oiic.n) > 0:
-            o32 = unp.log10(oiiic / oiic)
-            y.append(unp.nominal_values(o32))
-            yerr.append(unp.std_devs(o32))
-            calibrations.append('O32')
-
-        # ne3o2
-        if min(neiiic.n, oiic.n) > 0:
-            ne3o2 = unp.log10(neiiic / oiic)
-            y.append(unp.nominal_values(ne3o2))
-            yerr.append(unp.std_devs(ne3o2))
-            calibrations.append('Ne3O2')
-
-        # calculate model values and cast all lists as arrays
-        model = np.array([zcal.calibrations[cal](x) for cal in calibrations])
-        model_errs = np.array([zcal.calib_errors[cal] for cal in calibrations])
-        y = np.array(y)
-        yerr = np.array(yerr)
-
-        return -0.5 * np.sum(
-            (np.power(model - y, 2) / (yerr ** 2 + model_errs ** 2)) + 2 * np.log(yerr + model_errs)
-        )
-
-    def ptform(p:tuple) -> tuple:
-
-        # unpack variables
-        uOH, uEBV = p
-        pOH  = (zcal.options['range'][0] - 12.) + (uOH * np.diff(zcal.options['range'])[0])
-
-        pEBV = 2 * uEBV
-
-        return pOH, pEBV
-
-    sampler = dynesty.NestedSampler(loglikelihood = logl,
-                                    prior_transform = ptform,
-                                    ndim = 2, bootstrap = 0)
-
-    # run sampler
-    sampler.run_nested(print_progress=zcal.options['verbose'])
-    results = sampler.results
-
-    # create pickle file
-    outfile = open(f'{zcal.options["res_dir"]}/samplers/{id}_{scheme}_sampler.pkl', 'wb')
-    pickle.dump(sampler.results, outfile)
-    outfile.close
+        coeffs = utils.CoefficientTable(scheme, obs.calibrations)
+        model_errs = np.array([scheme.errors[cal] for cal in obs.calibrations])
+
+        # Cardelli kλ at the line wavelengths
+        k_lines = utils.Cardelli_k(list(scheme.wavelengths.values()))
+
+        logl = LogLikelihood(obs, coeffs, model_errs, scheme.oh_to_x, k_lines if correct else None, record)
+
+    # precomputed posterior table of this scheme and prior (objects outside its coverage or tolerance are fit as usual)
+    if correct and options['emulator'] is not None:
+        from zcal import emulator
+        with stats.Stage(record, 'emulator'):
+            table = emulator.Load(options['emulator'])
+            hit = False
+            if table.Applies(scheme, options['ebv_max']):
+                logOHp12, EBVs, ok = table.Query(oiii, oii, hb, neiii)
+                hit = bool(ok[0])
+        if hit:
+            with stats.Stage(record, 'io'):
+                SaveSummary('emulator', id, scheme, {'logOHp12': logOHp12[0], 'EBV': EBVs[0]}, options, rstate)
+            return logOHp12[0], EBVs[0]
+
+    # deterministic grid posterior
+    if options['method'] == 'grid':
+        with stats.Stage(record, 'grid'):
+            post = grid.GridPosterior(logl.batch, scheme.range, (0., options['ebv_max']), **options['grid'])
+        with stats.Stage(record, 'io'):
+            SaveSummary('grid', id, scheme, post, options, rstate)
+        return post['logOHp12'], post['EBV']
+
+    # fast MAP + Laplace estimate (ambiguous objects fall through to the sampler)
+    if options['method'] == 'laplace':
+        with stats.Stage(record, 'laplace'):
+            post = grid.LaplacePosterior(logl.batch, scheme.range, (0., options['ebv_max']), guesses=InitialGuesses(scheme, obs),
+                                          **options['laplace'])
+        if post['ok']:
+            with stats.Stage(record, 'io'):
+                SaveSummary('laplace', id, scheme, post, options, rstate)
+            return post['logOHp12'], post['EBV']
+        if options['verbose']:
+            print(f'-> [zcal]: object {id} is {"multimodal" if post["multimodal"] else "not gaussian"}, running the sampler.')
+
+    # run sampler (backend imported on first use)
+    from dynesty import utils as dyfunc
+    with stats.Stage(record, 'sampler'):
+        settings = SamplerSettings(obs, options['sampler'])
+        results = RunSampler(f'{id}_{scheme.name}_dust', logl, PriorTransform(scheme.range, options['ebv_max']), 2, options, rstate, settings)
+    stats.Sampler(record, results, settings)
 
     # extract results
     weights = np.exp(results['logwt'] - results['logz'][-1])
@@ -136,252 +416,72 @@ def FitZg_DustCorrect(id:str, scheme:str, oiii:np.ndarray, oii:np.ndarray, hb:np
     #print(f'          EBV = {ebv[1]} + {ebv[2]-ebv[1]} - {ebv[1]-ebv[0]}')
 
     # make corner plot if plotting
-    if zcal.options['corner_plots']:
-        cfig, caxes = dyplot.cornerplot(results, color='black', labels=['12+log(O/H)', 'E(B-V)'],
-                                        label_kwargs={'fontsize':25},
-                                        show_titles=True)
-        try:
-            plot_id = int(id)
-        except:
-            plot_id = id
-        cfig.savefig(f'{zcal.options["plot_dir"]}/corners/{plot_id}_{scheme}_corner.png')
+    if options['corner_plots']:
+        with stats.Stage(record, 'plot'):
+            plotting.Corner(results, ['12+log(O/H)', 'E(B-V)'], id, f'{scheme.name}_corner', options)
 
     # return to main
     logOHp12 = np.array([oh[1]+12, oh[2]-oh[1], oh[1]-oh[0]])
     EBVs = np.array([ebv[1], ebv[2]-ebv[1], ebv[1]-ebv[0]])
+    with stats.Stage(record, 'io'):
+        SaveResults(f'{id}_{scheme.name}_sampler', id, scheme, results, logOHp12, EBVs, options, rstate, settings)
     return logOHp12, EBVs
 
-def FitZg_NoDust_OLD(id:str, scheme:str, oiii:np.ndarray, oii:np.ndarray, hb:np.ndarray, neiii:np.ndarray) -> np.ndarray:
-    
-    # initialise parameters
-    utils.SetCalibration(scheme)
-
-    def logl(u:tuple) -> float:
-        
-        oh = u
+def FitZg_NoDust_OLD(id:str, scheme:str, oiii:np.ndarray, oii:np.ndarray, hb:np.ndarray, neiii:np.ndarray, rstate:np.random.Generator = None, options:dict = None) -> np.ndarray:
+    """ Deprecated: FitZg_NoDust is now a true 1D fit (with the current [OIII] conventions) """
+    return FitZg_NoDust(id, scheme, oiii, oii, hb, neiii, rstate=rstate, options=options)
 
-        #  convert u into correct form for calibration
-        x = zcal.options['oh_to_x'](oh)
+@stats.Instrumented
+@cache.Cached
+def FitZg_NoDust(id:str, scheme:str, oiii:np.ndarray, oii:np.ndarray, hb:np.ndarray, neiii:np.ndarray, rstate:np.random.Generator = None, options:dict = None) -> np.ndarray:
     
-        # generate ufloats for objects
-        if oiii[1] >= 0.:
-            oiiic = ufloat((4/3)*oiii[0], (4/3)*oiii[1])
-        else:
-            oiiic = ufloat(-999.0, 0.)
-
-        if oii[1] >= 0.:
-            oiic = ufloat(oii[0], oii[1])
-        else:
-            oiic = ufloat(-999.0, 0.)
-
-        if hb[1] >= 0.:
-            hbc = ufloat(hb[0], hb[1])
-        else:
-            hbc = ufloat(-999.0, 0.)
-
-        if neiii[1] >= 0.:
-            neiiic = ufloat(neiii[0], neiii[1])
-        else:
-            neiiic = ufloat(-999.0, 0.0)
-
-        if min(oiiic.n, oiic.n) < 0:
+    # calibration scheme and runtime options
+    scheme = utils.GetScheme(scheme)
+    options = zcal.options if options is None else options
+    record = stats.Current()
+
+    # precompute observed ratios and active calibrations
+    with stats.Stage(record, 'preprocess'):
+        obs = Observe(scheme.name, oiii, oii, hb, neiii)
+        if not obs.valid:
             return np.ones(3) * -999.0
- 
-        # set up arrays
-        y, yerr, calibrations = [], [], []
-
-        # o3
-        if min(oiiic.n, hbc.n) > 0:
-            o3 = unp.log10(oiiic / hbc)
-            y.append(unp.nominal_values(o3))
-            yerr.append(unp.std_devs(o3))
-            calibrations.append('O3')
-
-        # o2
-        if (min(oiic.n, hbc.n) > 0) & (scheme != 'bian'):
-            o2 = unp.log10(oiic / hbc)
-            y.append(unp.nominal_values(o2))
-            yerr.append(unp.std_devs(o2))
-            calibrations.append('O2')
-
-        # r23
-        if (min(oiiic.n, oiic.n, hbc.n) > 0) & (scheme != 'bian'):
-            r23 = unp.log10((oiiic + oiic) / hbc)
-            y.append(unp.nominal_values(r23))
-            yerr.append(unp.std_devs(r23))
-            calibrations.append('R23')
-
-        # o32
-        if min(oiiic.n, oiic.n) > 0:
-            o32 = unp.log10(oiiic / oiic)
-            y.append(unp.nominal_values(o32))
-            yerr.append(unp.std_devs(o32))
-            calibrations.append('O32')
-
-        # ne3o2
-        if min(neiiic.n, oiic.n) > 0:
-            ne3o2 = unp.log10(neiiic / oiic)
-            y.append(unp.nominal_values(ne3o2))
-            yerr.append(unp.std_devs(ne3o2))
-            calibrations.append('Ne3O2')
-
-        # calculate model values and cast all lists as arrays
-        model = np.array([zcal.calibrations[cal](x) for cal in calibrations])
-        model_errs = np.array([zcal.calib_errors[cal] for cal in calibrations])
-        y = np.array(y)
-        yerr = np.array(yerr)
-
-        return -0.5 * np.sum(
-            (np.power(model - y, 2) / (yerr ** 2 + model_errs ** 2)) + 2 * np.log(yerr + model_errs)
-        )
-
-    def ptform(p:tuple) -> tuple:
-        return (zcal.options['range'][0] - 12.) + (p * np.diff(zcal.options['range'])[0])
-
-
-    sampler = dynesty.NestedSampler(loglikelihood = logl,
-                                    prior_transform = ptform,
-                                    ndim = 1, bootstrap = 0)
-
-    # run sampler
-    sampler.run_nested(print_progress=zcal.options['verbose'])
-    results = sampler.results
-
-    # create pickle file
-    outfile = open(f'{zcal.options["res_dir"]}/samplers/{id}_{scheme}sampler.pkl', 'wb')
-    pickle.dump(sampler.results, outfile)
-    outfile.close
-
-    # extract results
-    weights = np.exp(results['logwt'] - results['logz'][-1])
-    oh = dyfunc.quantile(x=results['samples'][:,0], q=[0.16, 0.50, 0.84], weights=weights)
-
-    # make corner plot if plotting
-    if zcal.options['corner_plots']:
-        cfig, caxes = dyplot.cornerplot(results, color='black', labels=['log(O/H)',],
-                                        label_kwargs={'fontsize':25},
-                                        show_titles=True)
-        try:
-            plot_id = int(id)
-        except:
-            plot_id = id
-        cfig.savefig(f'{zcal.options["plot_dir"]}/corners/{plot_id}_{scheme}_corner_1d.png')
-
-    # return to main
-    logOHp12 = np.array([oh[1]+12, oh[2]-oh[1], oh[1]-oh[0]])
-    return logOHp12
-
-def FitZg_NoDust(id:str, scheme:str, oiii:np.ndarray, oii:np.ndarray, hb:np.ndarray, neiii:np.ndarray) -> np.ndarray:
-    
-    # initialise parameters
-    utils.SetCalibration(scheme)
-
-    def logl(u:tuple) -> float:
-        
-        # unpack parameters
-        oh, _ = u
-        
-        #  convert x into correct form for calibration
-        x = zcal.options['oh_to_x'](oh)
-    
-        corrections = np.ones(len(zcal.wavelengths), dtype=float)
-
-        # generate ufloats for objects
-        if oiii[1] >= 0.:
-            factor = 1.0 if scheme == 'nakajima' else (4/3) # nakajima conversion
-            oiiic = ufloat(factor*oiii[0]*corrections[0], factor*oiii[1]*corrections[0])
-        else:
-            oiiic = ufloat(-999.0, 0.)
-
-        if oii[1] >= 0.:
-            oiic = ufloat(oii[0]*corrections[1], oii[1]*corrections[1])
-        else:
-            oiic = ufloat(-999.0, 0.)
-
-        if hb[1] >= 0.:
-            hbc = ufloat(hb[0]*corrections[2], hb[1]*corrections[2])
-        else:
-            hbc = ufloat(-999.0, 0.)
-
-        if neiii[1] >= 0.:
-            neiiic = ufloat(neiii[0]*corrections[3], neiii[1]*corrections[3])
-        else:
-            neiiic = ufloat(-999.0, 0.0)
-
-        if min(oiiic.n, oiic.n) < 0:
-            return np.ones(3) * -999.0, np.ones(3) * -999.0
- 
-        # set up arrays
-        y, yerr, calibrations = [], [], []
-
-        # o3
-        if min(oiiic.n, hbc.n) > 0:
-            o3 = unp.log10(oiiic / hbc)
-            y.append(unp.nominal_values(o3))
-            yerr.append(unp.std_devs(o3))
-            calibrations.append('O3')
-
-        # o2
-        if (min(oiic.n, hbc.n) > 0) & (scheme != 'bian'):
-            o2 = unp.log10(oiic / hbc)
-            y.append(unp.nominal_values(o2))
-            yerr.append(unp.std_devs(o2))
-            calibrations.append('O2')
-
-        # r23
-        if (min(oiiic.n, oiic.n, hbc.n) > 0) & (scheme != 'bian'):
-            factor = 4/3 if scheme == 'nakajima' else 1.0 # handle nakajima conversion
-            r23 = unp.log10(((oiiic * factor) + oiic) / hbc)
-            y.append(unp.nominal_values(r23))
-            yerr.append(unp.std_devs(r23))
-            calibrations.append('R23')
-            
-        # o32
-        if min(oiiic.n, oiic.n) > 0:
-            o32 = unp.log10(oiiic / oiic)
-            y.append(unp.nominal_values(o32))
-            yerr.append(unp.std_devs(o32))
-            calibrations.append('O32')
-
-        # ne3o2
-        if min(neiiic.n, oiic.n) > 0:
-            ne3o2 = unp.log10(neiiic / oiic)
-            y.append(unp.nominal_values(ne3o2))
-            yerr.append(unp.std_devs(ne3o2))
-            calibrations.append('Ne3O2')
-
-        # calculate model values and cast all lists as arrays
-        model = np.array([zcal.calibrations[cal](x) for cal in calibrations])
-        model_errs = np.array([zcal.calib_errors[cal] for cal in calibrations])
-        y = np.array(y)
-        yerr = np.array(yerr)
-
-        return -0.5 * np.sum(
-            (np.power(model - y, 2) / (yerr ** 2 + model_errs ** 2)) + 2 * np.log(yerr + model_errs)
-        )
-
-    def ptform(p:tuple) -> tuple:
-
-        # unpack variables
-        uOH, uEBV = p
-        pOH  = (zcal.options['range'][0] - 12.) + (uOH * np.diff(zcal.options['range'])[0])
-
-        pEBV = 2 * uEBV
-
-        return pOH, pEBV
-
-    sampler = dynesty.NestedSampler(loglikelihood = logl,
-                                    prior_transform = ptform,
-                                    ndim = 2, bootstrap = 0)
-
-    # run sampler
-    sampler.run_nested(print_progress=zcal.options['verbose'])
-    results = sampler.results
-
-    # create pickle file
-    outfile = open(f'{zcal.options["res_dir"]}/samplers/{id}_{scheme}_sampler.pkl', 'wb')
-    pickle.dump(sampler.results, outfile)
-    outfile.close
+        coeffs = utils.CoefficientTable(scheme, obs.calibrations)
+        model_errs = np.array([scheme.errors[cal] for cal in obs.calibrations])
+
+        logl = LogLikelihood(obs, coeffs, model_errs, scheme.oh_to_x, record=record)
+
+    # deterministic grid / 1D quadrature posteriors
+    post = None
+    if options['method'] == 'grid':
+        with stats.Stage(record, 'grid'):
+            post = grid.GridPosterior(logl.batch, scheme.range, dust=False, **options['grid'])
+    elif options['method'] == 'quad':
+        with stats.Stage(record, 'quad'):
+            post = grid.QuadPosterior(logl.batch, scheme.range, **options['quad'])
+    elif options['method'] == 'mc':
+        from zcal import batch
+        with stats.Stage(record, 'mc'):
+            post = {'logOHp12': batch.MonteCarloCatalogue(scheme, *[np.reshape(f, (1, 2)) for f in (oiii, oii, hb, neiii)],
+                                                          seed=rstate, **options['mc'])[0]}
+    elif options['method'] == 'laplace':
+        with stats.Stage(record, 'laplace'):
+            post = grid.LaplacePosterior(logl.batch, scheme.range, dust=False, guesses=InitialGuesses(scheme, obs),
+                                          **options['laplace'])
+        if not post['ok']:
+            if options['verbose']:
+                print(f'-> [zcal]: object {id} is {"multimodal" if post["multimodal"] else "not gaussian"}, running the sampler.')
+            post = None
+    if post is not None:
+        with stats.Stage(record, 'io'):
+            SaveSummary(options['method'], id, scheme, post, options, rstate)
+        return post['logOHp12']
+
+    # run sampler (backend imported on first use)
+    from dynesty import utils as dyfunc
+    with stats.Stage(record, 'sampler'):
+        settings = SamplerSettings(obs, options['sampler'])
+        results = RunSampler(f'{id}_{scheme.name}_nodust', logl, PriorTransform(scheme.range), 1, options, rstate, settings)
+    stats.Sampler(record, results, settings)
 
     # extract results
     weights = np.exp(results['logwt'] - results['logz'][-1])
@@ -391,17 +491,99 @@ def FitZg_NoDust(id:str, scheme:str, oiii:np.ndarray, oii:np.ndarray, hb:np.ndar
     #print(f'          EBV = {ebv[1]} + {ebv[2]-ebv[1]} - {ebv[1]-ebv[0]}')
 
     # make corner plot if plotting
-    if zcal.options['corner_plots']:
-        cfig, caxes = dyplot.cornerplot(results, color='black', labels=['12+log(O/H)', 'E(B-V)'],
-                                        label_kwargs={'fontsize':25},
-                                        show_titles=True)
-        try:
-            plot_id = int(id)
-        except:
-            plot_id = id
-        cfig.savefig(f'{zcal.options["plot_dir"]}/corners/{plot_id}_{scheme}_corner.png')
+    if options['corner_plots']:
+        with stats.Stage(record, 'plot'):
+            plotting.Corner(results, ['12+log(O/H)'], id, f'{scheme.name}_corner', options)
 
     # return to main
     logOHp12 = np.array([oh[1]+12, oh[2]-oh[1], oh[1]-oh[0]])
     #EBVs = np.array([ebv[1], ebv[2]-ebv[1], ebv[1]-ebv[0]])
-    return logOHp12
\ No newline at end of file
+    with stats.Stage(record, 'io'):
+        SaveResults(f'{id}_{scheme.name}_sampler', id, scheme, results, logOHp12, np.full(3, np.nan), options, rstate, settings)
+    return logOHp12
+# -=-=-=- MULTI-SCHEME FITTING -=-=-=-
+
+class SharedLikelihood:
+    """ Log-likelihoods of one object under several schemes, sharing the dust corrections and line ratios at each set of points """
+
+    def __init__(self, flux:np.ndarray, flux_err:np.ndarray, schemes:list, k_lines:np.ndarray = None, nakajima:bool = True):
+        self.flux, self.flux_err, self.k_lines = flux, flux_err, k_lines
+        self.schemes = {}
+        for scheme in schemes:
+            num, den = RatioWeights(scheme.name, nakajima)
+            mask, valid = DiagnosticMask(scheme.name, flux)
+            active = tuple(np.array(diagnostics)[mask])
+            self.schemes[scheme.name] = {'valid': bool(valid), 'calibrations': active, 'mask': mask,
+                                         'weights': (num, den), 'coeffs': utils.CoefficientTable(scheme, active),
+                                         'model_errs': np.array([scheme.errors[cal] for cal in active]),
+                                         'oh_to_x': scheme.oh_to_x}
+        self._cache = {} # (corrections, {convention: ratios}) of the two most recent point sets
+
+    def _Ratios(self, points:np.ndarray, weights:tuple) -> tuple:
+        """ All five (dust-corrected) log ratios at a set of points, computed once per [OIII] convention """
+
+        # the shared first-pass grid stays cached while each scheme refines around its own peak
+        key = hash(np.ascontiguousarray(points).tobytes())
+        if key not in self._cache:
+            if len(self._cache) >= 2:
+                self._cache.pop(next(iter(self._cache)))
+            self._cache[key] = (None, {})
+        self._cache[key] = entry = self._cache.pop(key) # most recently used last
+        corrections, ratios = entry
+
+        convention = weights[0].tobytes()
+        if convention not in ratios:
+            if self.k_lines is None:
+                flux, flux_err = self.flux[None, :], self.flux_err[None, :]
+            else:
+                if corrections is None:
+                    corrections = np.power(10, 0.4 * points[:, 1:2] * self.k_lines)
+                    self._cache[key] = (corrections, ratios)
+                flux, flux_err = self.flux * corrections, self.flux_err * corrections
+            with np.errstate(all='ignore'): # missing lines only enter inactive diagnostics
+                ratios[convention] = LogRatios(Observation(True, tuple(diagnostics), flux, flux_err, *weights, None, None))
+        return ratios[convention]
+
+    def For(self, name:str):
+        """ Batch likelihood of one scheme, reusing corrections and ratios already computed at the same points """
+        s = self.schemes[name]
+
+        def logl_batch(points:np.ndarray) -> np.ndarray:
+            points = np.atleast_2d(points)
+            y, yerr = self._Ratios(points, s['weights'])
+            y, yerr = y[:, s['mask']], yerr[:, s['mask']]
+            model = utils.Horner(s['coeffs'], s['oh_to_x'](points[:, 0]))
+            return -0.5 * np.sum(
+                (np.power(model - y, 2) / (yerr ** 2 + s['model_errs'] ** 2)) + 2 * np.log(yerr + s['model_errs']), axis=-1
+            )
+        return logl_batch
+
+def FitZg_MultiScheme(id:str, schemes:list, oiii:np.ndarray, oii:np.ndarray, hb:np.ndarray, neiii:np.ndarray, dust:bool = True,
+                      rstate:np.random.Generator = None, options:dict = None) -> dict:
+    """ Fits one object with several calibration schemes, returning {scheme: (logOHp12, EBVs)} """
+
+    # calibration schemes and runtime options
+    schemes = [utils.GetScheme(scheme) for scheme in schemes]
+    options = zcal.options if options is None else options
+
+    # samplers (and the 1D / Laplace methods) run per scheme
+    if options['method'] != 'grid':
+        if dust:
+            return {s.name: FitZg_DustCorrect(id, s, oiii, oii, hb, neiii, rstate=rstate, options=options) for s in schemes}
+        return {s.name: (FitZg_NoDust(id, s, oiii, oii, hb, neiii, rstate=rstate, options=options), np.full(3, np.nan))
+                for s in schemes}
+
+    # shared line fluxes, dust coefficients and first-pass grid for every scheme
+    flux, flux_err = LineFluxes(oiii, oii, hb, neiii)
+    k_lines = utils.Cardelli_k(list(schemes[0].wavelengths.values())) if dust else None
+    shared = SharedLikelihood(flux, flux_err, schemes, k_lines, nakajima=not dust)
+
+    results = {}
+    for scheme in schemes:
+        if not shared.schemes[scheme.name]['valid']:
+            results[scheme.name] = np.ones(3) * -999.0, np.ones(3) * -999.0
+            continue
+        post = grid.GridPosterior(shared.For(scheme.name), scheme.range, (0., options['ebv_max']), dust=dust, **options['grid'])
+        SaveSummary('grid', id, scheme, post, options, rstate)
+        results[scheme.name] = post['logOHp12'], post['EBV']
+    return results
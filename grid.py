@@ -0,0 +1,172 @@
+# imports
+import numpy as np
+
+# -=-=-=- GRID POSTERIOR METHODS -=-=-=-
+
+def GridQuantiles(x:np.ndarray, p:np.ndarray, q:tuple = (0.16, 0.50, 0.84)) -> np.ndarray:
+    """ Quantiles of (uniformly spaced) gridded marginals p (..., n), treating grid points as cell centres
+        (the end cells stop at the grid limits, so endpoint nodes carry half weight and quantiles stay in range) """
+    dx = x[1] - x[0] if len(x) > 1 else 1.
+    edges = np.append(x - dx / 2., x[-1] + dx / 2.)
+    if len(x) > 1:
+        edges[0], edges[-1] = x[0], x[-1]
+    widths = np.diff(edges)
+    cdf = np.cumsum(p * widths / dx, axis=-1)
+    cdf = np.concatenate([np.zeros(cdf.shape[:-1] + (1,)), cdf], axis=-1) / cdf[..., -1:]
+
+    # linear interpolation of each cdf, row by row
+    quantiles = []
+    for qi in q:
+        j = np.clip(np.sum(cdf < qi, axis=-1, keepdims=True), 1, len(x))
+        c0, c1 = np.take_along_axis(cdf, j - 1, -1), np.take_along_axis(cdf, j, -1)
+        frac = (qi - c0) / np.where(c1 > c0, c1 - c0, 1.)
+        quantiles.append((edges[j - 1] + frac * widths[j - 1])[..., 0])
+    return np.stack(quantiles, axis=-1)
+
+def _Marginals(logl:np.ndarray) -> tuple:
+    post = np.exp(logl - np.max(logl))
+    return post.sum(axis=1), post.sum(axis=0), post
+
+def _Zoom(x:np.ndarray, p:np.ndarray, tol:float) -> tuple:
+    """ Range of x containing all grid cells above tol * max(p), padded by one cell """
+    keep = np.flatnonzero(p > tol * p.max())
+    lo, hi = max(keep[0] - 1, 0), min(keep[-1] + 1, len(x) - 1)
+    return x[lo], x[hi]
+
+def GridPosterior(logl_batch, oh_range:tuple, ebv_range:tuple = (0., 2.), n_oh:int = 400, n_ebv:int = 200,
+                  refine:int = 1, tol:float = 1e-6, dust:bool = True) -> dict:
+    """ Evaluates the likelihood on a dense (log O/H x E(B-V)) mesh, returning quantiles and marginals """
+
+    # parameter ranges (log O/H sampled in the same space as ptform)
+    oh_lims = (oh_range[0] - 12., oh_range[1] - 12.)
+    ebv_lims = tuple(ebv_range) if dust else (0., 0.)
+    n_ebv = n_ebv if dust else 1
+
+    for i in range(refine + 1):
+
+        # evaluate the full mesh in one call
+        oh = np.linspace(*oh_lims, n_oh)
+        ebv = np.linspace(*ebv_lims, n_ebv)
+        OH, EBV = np.meshgrid(oh, ebv, indexing='ij')
+        logl = logl_batch(np.column_stack([OH.ravel(), EBV.ravel()])).reshape(n_oh, n_ebv)
+        p_oh, p_ebv, post = _Marginals(logl)
+
+        # zoom in around the peak
+        if i < refine:
+            oh_lims = _Zoom(oh, p_oh, tol)
+            if dust:
+                ebv_lims = _Zoom(ebv, p_ebv, tol)
+
+    # summarise
+    q_oh = GridQuantiles(oh, p_oh)
+    logOHp12 = np.array([q_oh[1]+12, q_oh[2]-q_oh[1], q_oh[1]-q_oh[0]])
+    if dust:
+        q_ebv = GridQuantiles(ebv, p_ebv)
+        EBVs = np.array([q_ebv[1], q_ebv[2]-q_ebv[1], q_ebv[1]-q_ebv[0]])
+    else:
+        EBVs = np.full(3, np.nan)
+
+    return {'logOHp12': logOHp12, 'EBV': EBVs,
+            'oh': oh + 12., 'p_oh': p_oh / p_oh.sum(),
+            'ebv': ebv, 'p_ebv': p_ebv / p_ebv.sum(),
+            'posterior': post / post.sum()}
+
+def QuadPosterior(logl_batch, oh_range:tuple, n:int = 2001, n_coarse:int = 400, tol:float = 1e-12) -> dict:
+    """ 1D posterior in log O/H by trapezoidal quadrature over the support of the likelihood """
+
+    # locate the support on a coarse grid, then integrate finely across it
+    oh = np.linspace(oh_range[0] - 12., oh_range[1] - 12., n_coarse)
+    logl = logl_batch(oh[:, None])
+    oh = np.linspace(*_Zoom(oh, np.exp(logl - np.max(logl)), tol), n)
+    logl = logl_batch(oh[:, None])
+    post = np.exp(logl - np.max(logl))
+
+    # cumulative distribution at the nodes, inverted for quantiles
+    cdf = np.append(0., np.cumsum(0.5 * (post[1:] + post[:-1]) * np.diff(oh)))
+    q_oh = np.interp([0.16, 0.50, 0.84], cdf / cdf[-1], oh)
+
+    return {'logOHp12': np.array([q_oh[1]+12, q_oh[2]-q_oh[1], q_oh[1]-q_oh[0]]),
+            'oh': oh + 12., 'p_oh': post / cdf[-1],
+            'logz': np.log(cdf[-1] / np.diff(oh_range)[0]) + np.max(logl)}
+
+# -=-=-=- OPTIMISER (MAP + LAPLACE) METHODS -=-=-=-
+
+def _LocalMaxima(p:np.ndarray) -> np.ndarray:
+    """ Indices of the local maxima of a 1D profile (plateaus report their first point) """
+    padded = np.concatenate([[-np.inf], p, [-np.inf]])
+    return np.flatnonzero((padded[1:-1] > padded[:-2]) & (padded[1:-1] >= padded[2:]))
+
+def Hessian(logl_batch, x:np.ndarray, h:np.ndarray) -> np.ndarray:
+    """ Central finite-difference Hessian of the log-likelihood at x, evaluated in one batch """
+    ndim = len(x)
+    steps = [(i, j, si, sj) for i in range(ndim) for j in range(i, ndim) for si in (1, -1) for sj in (1, -1)]
+    points = np.array([x + si * h[i] * np.eye(ndim)[i] + sj * h[j] * np.eye(ndim)[j] for i, j, si, sj in steps])
+    logl = logl_batch(points)
+
+    H = np.zeros((ndim, ndim))
+    for (i, j, si, sj), value in zip(steps, logl):
+        H[i, j] += si * sj * value / (4 * h[i] * h[j])
+    return np.triu(H) + np.triu(H, 1).T
+
+def LaplacePosterior(logl_batch, oh_range:tuple, ebv_range:tuple = (0., 2.), dust:bool = True,
+                     n_coarse:int = 60, delta_logl:float = 3., n_sigma:float = 2., step:float = 1e-4,
+                     guesses:np.ndarray = None) -> dict:
+    """ Multi-start bounded MAP with Hessian (Laplace) errors, flagging multimodal or boundary-limited posteriors """
+    from scipy import optimize
+
+    lims = [(oh_range[0] - 12., oh_range[1] - 12.)] + ([tuple(ebv_range)] if dust else [])
+
+    # coarse profile likelihood in log O/H locates every branch
+    oh = np.linspace(*lims[0], n_coarse)
+    if dust:
+        ebv = np.linspace(*lims[1], max(n_coarse // 2, 2))
+        OH, EBV = np.meshgrid(oh, ebv, indexing='ij')
+        logl = logl_batch(np.column_stack([OH.ravel(), EBV.ravel()])).reshape(len(oh), len(ebv))
+        profile = np.max(logl, axis=1)
+        starts = np.column_stack([oh, ebv[np.argmax(logl, axis=1)]])
+    else:
+        profile = logl_batch(oh[:, None])
+        starts = oh[:, None]
+    peaks = _LocalMaxima(profile)
+    peaks = peaks[profile[peaks] > np.max(profile) - 2 * delta_logl] # coarse grid is only approximate
+
+    # extra starts at initial guesses of log O/H (e.g. calibration inverses), paired with the best E(B-V) nearby
+    if guesses is not None and len(guesses):
+        covered = list(oh[peaks])
+        for guess in np.sort(guesses):
+            if all(abs(guess - c) >= 2 * (oh[1] - oh[0]) for c in covered):
+                covered.append(guess)
+        guesses = np.array(covered[len(peaks):])
+        nearest = np.clip(np.searchsorted(oh, guesses), 0, len(oh) - 1)
+        starts = np.concatenate([starts[peaks], np.column_stack([guesses, starts[nearest, 1:]])])
+    else:
+        starts = starts[peaks]
+
+    # refine each branch with a bounded optimiser, merging starts that converge together
+    modes = []
+    for x0 in starts:
+        fit = optimize.minimize(lambda x: -logl_batch(x)[0], x0, method='L-BFGS-B', bounds=lims)
+        if not any(abs(fit.x[0] - mode[0][0]) < 2 * (oh[1] - oh[0]) for mode in modes):
+            modes.append((fit.x, -fit.fun))
+    modes.sort(key=lambda mode: -mode[1])
+    x, logl_max = modes[0]
+    multimodal = any(logl_max - mode[1] < delta_logl for mode in modes[1:])
+
+    # Laplace approximation about the MAP
+    h = step * np.array([hi - lo for lo, hi in lims])
+    H = Hessian(logl_batch, x, h)
+    gaussian = bool(np.all(np.linalg.eigvalsh(-H) > 0))
+    if gaussian:
+        cov = np.linalg.inv(-H)
+        sigma = np.sqrt(np.diag(cov))
+    else:
+        cov, sigma = np.full_like(H, np.nan), np.full(len(x), np.nan)
+
+    # the gaussian must also sit inside the prior bounds
+    inside = gaussian and all(lo <= xi - n_sigma * si and xi + n_sigma * si <= hi for xi, si, (lo, hi) in zip(x, sigma, lims))
+
+    return {'logOHp12': np.array([x[0]+12, sigma[0], sigma[0]]),
+            'EBV': np.array([x[1], sigma[1], sigma[1]]) if dust else np.full(3, np.nan),
+            'map': x, 'cov': cov, 'logl': logl_max,
+            'modes': np.array([mode[0] for mode in modes]), 'multimodal': multimodal,
+            'ok': inside and not multimodal}
@@ -0,0 +1,40 @@
+# imports
+import zcal
+from zcal import utils, fitting
+import numpy as np
+
+# -=-=-=- SYNTHETIC GALAXIES -=-=-=-
+
+def SyntheticGalaxies(scheme:str, n:int = 100, snr:float = 10., missing:dict = None, oh_range:tuple = (7.6, 8.6),
+                      ebv_range:tuple = (0., 1.), dust:bool = True, seed:int = 0) -> dict:
+    """ Mock (N, 2) line fluxes from a scheme's calibrations at known 12+log(O/H) and E(B-V), with snr a single
+        S/N or one per line (oiii, oii, hb, neiii)
+
+    missing maps a line ('oiii', 'oii', 'hb', 'neiii') to the fraction of objects without it (flagged -999) """
+    scheme = utils.GetScheme(scheme)
+    rng = np.random.default_rng(seed)
+
+    # truths
+    logOHp12 = rng.uniform(*oh_range, n)
+    EBV = rng.uniform(*ebv_range, n) if dust else np.zeros(n)
+
+    # intrinsic fluxes relative to Hβ from the O3, O32 and Ne3O2 calibrations
+    # (with the [OIII] convention of the fit being benchmarked)
+    x = scheme.oh_to_x(logOHp12 - 12.)
+    O3, O32, Ne3O2 = utils.Horner(utils.CoefficientTable(scheme, ['O3', 'O32', 'Ne3O2']), x).T
+    factor = fitting.RatioWeights(scheme.name, nakajima=not dust)[0][0, 0]
+    oiii = np.power(10, O3) / factor
+    oii = factor * oiii / np.power(10, O32)
+    flux = np.column_stack([oiii, oii, np.ones(n), np.power(10, Ne3O2) * oii])
+
+    # reddening, then noise at a fixed S/N per line
+    flux = flux * np.power(10, -0.4 * EBV[:, None] * utils.Cardelli_k(list(scheme.wavelengths.values())))
+    err = flux / np.asarray(snr, dtype=float)
+    flux = flux + err * rng.standard_normal(flux.shape)
+
+    lines = {}
+    for i, line in enumerate(['oiii', 'oii', 'hb', 'neiii']):
+        lines[line] = np.column_stack([flux[:, i], err[:, i]])
+        drop = rng.uniform(size=n) < (missing or {}).get(line, 0.)
+        lines[line][drop] = -999.
+    return {'ids': np.arange(n).astype(str), 'logOHp12': logOHp12, 'EBV': EBV, **lines}
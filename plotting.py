@@ -0,0 +1,107 @@
+# imports
+import numpy as np
+import os, sys, glob, atexit
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import util as mputil
+
+# background renderer of this process (created on first use) and its outstanding jobs
+_executor = None
+_executor_pid = None
+_pending = []
+max_pending = 16
+
+# -=-=-=- RENDERING -=-=-=-
+
+def PlotName(id:str, suffix:str) -> str:
+    """ File stem of a corner plot (integer-like ids are written without padding) """
+    try:
+        plot_id = int(id)
+    except:
+        plot_id = id
+    return f'{plot_id}_{suffix}'
+
+def RenderCorner(data:dict, labels:list, path:str) -> None:
+    """ Renders a corner plot from minimal sampler output, closing the figure afterwards """
+    import matplotlib.pyplot as plt
+    from dynesty import plotting as dyplot
+    from dynesty.results import Results
+
+    # rebuild a Results object from the stored columns
+    results = data if isinstance(data, Results) else Results({
+        'samples': data['samples'], 'samples_u': data['samples'], 'samples_id': np.zeros(len(data['samples']), dtype=int),
+        'logl': data['logl'], 'logwt': data['logwt'], 'logz': data['logz'], 'nlive': int(data['nlive'])})
+
+    cfig, caxes = dyplot.cornerplot(results, color='black', labels=list(labels),
+                                    label_kwargs={'fontsize':25},
+                                    show_titles=True)
+    cfig.savefig(path)
+    plt.close(cfig)
+
+def _Minimal(results) -> dict:
+    """ The columns of a dynesty Results needed to render its corner plot """
+    return {'samples': results['samples'], 'logl': results['logl'], 'logwt': results['logwt'],
+            'logz': results['logz'], 'nlive': results['nlive']}
+
+# -=-=-=- PLOTTING MODES -=-=-=-
+
+def Corner(results, labels:list, id:str, suffix:str, options:dict) -> None:
+    """ Corner plot of a fit: options['corner_plots'] is True (now), 'background' or 'defer' """
+    mode = options['corner_plots']
+    name = PlotName(id, suffix)
+    path = f'{options["plot_dir"]}/corners/{name}.png'
+
+    if mode == 'defer':
+        # write the data needed to render later (python -m zcal.plotting <plot_dir>)
+        pending_dir = f'{options["plot_dir"]}/corners/pending'
+        os.makedirs(pending_dir, exist_ok=True)
+        tmp = f'{pending_dir}/.{name}.tmp.npz'
+        np.savez(tmp, labels=np.array(labels), **_Minimal(results))
+        os.replace(tmp, f'{pending_dir}/{name}.npz')
+    elif mode == 'background':
+        Submit(_Minimal(results), labels, path)
+    else:
+        RenderCorner(results, labels, path)
+
+def Submit(data:dict, labels:list, path:str) -> None:
+    """ Queues a corner plot on the background renderer, waiting if too many are outstanding """
+    global _executor, _executor_pid
+    # a forked child cannot use its parent's renderer
+    if _executor is None or _executor_pid != os.getpid():
+        _executor, _executor_pid = ProcessPoolExecutor(max_workers=1), os.getpid()
+        _pending.clear()
+        atexit.register(Shutdown)
+        # atexit hooks do not run in pool workers, multiprocessing finalizers do (ahead of the
+        # executor's own queues, which close at priority 10)
+        mputil.Finalize(None, Shutdown, exitpriority=20)
+    while len(_pending) >= max_pending:
+        _pending.pop(0).result()
+    _pending.append(_executor.submit(RenderCorner, data, labels, path))
+
+def Wait() -> None:
+    """ Blocks until every queued background plot has been written """
+    while _pending:
+        _pending.pop(0).result()
+
+def Shutdown() -> None:
+    """ Waits for the queued background plots, then stops this process's renderer """
+    global _executor
+    if _executor is None or _executor_pid != os.getpid():
+        return
+    Wait()
+    _executor.shutdown(wait=True)
+    _executor = None
+
+def RenderPending(plot_dir:str) -> int:
+    """ Renders (and removes) every deferred corner plot in a plot directory """
+    rendered = 0
+    for path in sorted(glob.glob(f'{plot_dir}/corners/pending/*.npz')):
+        name = os.path.basename(path)[:-4]
+        with np.load(path) as data:
+            RenderCorner(data, [str(l) for l in data['labels']], f'{plot_dir}/corners/{name}.png')
+        os.remove(path)
+        rendered += 1
+    return rendered
+
+if __name__ == '__main__':
+    for plot_dir in sys.argv[1:]:
+        print(f'-> [zcal]: rendered {RenderPending(plot_dir)} corner plots in {plot_dir}')
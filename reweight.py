@@ -0,0 +1,127 @@
+# imports
+import zcal
+from zcal import utils, batch, fitting, store
+import numpy as np
+import os, pickle
+
+# -=-=-=- STORED POSTERIORS -=-=-=-
+
+def _Load(id:str, scheme:utils.CalibrationScheme, options:dict) -> tuple:
+    """ Posterior samples (log O/H[, E(B-V)]), log-weights and log-likelihoods (None if not saved) of a stored fit """
+    if options['output'] == 'pickle':
+        path = f'{options["res_dir"]}/samplers/{id}_{scheme.name}_sampler.pkl'
+        if not os.path.exists(path):
+            return None
+        with open(path, 'rb') as infile:
+            results = pickle.load(infile)
+        return np.asarray(results['samples']), np.asarray(results['logwt']), np.asarray(results['logl'])
+
+    # stores keep equal-weight samples only (their likelihoods are recomputed)
+    elif options['output'] == 'store':
+        reader = store.ReadStore(options['store_dir'])
+        try:
+            samples = np.array(reader.Get(str(id), scheme.name)['samples'], dtype=float)
+        except KeyError:
+            return None
+        finally:
+            reader.Close()
+        samples[:, 0] -= 12.
+        samples = samples[:, :1] if np.all(np.isnan(samples[:, 1])) else samples
+        return samples, np.zeros(len(samples)), None
+    return None
+
+def _LogL(scheme:utils.CalibrationScheme, fluxes:list, dust:bool):
+    """ Log-likelihood of an object under a scheme, as built by the FitZg_* methods (None if the object cannot be fit) """
+    obs = fitting.Observe(scheme.name, *fluxes, nakajima=not dust)
+    if not obs.valid:
+        return None
+    return fitting.LogLikelihood(obs, utils.CoefficientTable(scheme, obs.calibrations),
+                                 np.array([scheme.errors[cal] for cal in obs.calibrations]), scheme.oh_to_x,
+                                 utils.Cardelli_k(list(scheme.wavelengths.values())) if dust else None)
+
+# -=-=-=- IMPORTANCE REWEIGHTING -=-=-=-
+
+def Reweight(id:str, scheme:str, oiii:np.ndarray, oii:np.ndarray, hb:np.ndarray, neiii:np.ndarray, new_scheme:str = None,
+             ebv_max:float = None, dust:bool = True, old_ebv_max:float = None, options:dict = None) -> dict:
+    """ Summaries of a stored fit importance-reweighted to new_scheme's errors / range (e.g. a utils.RegisterVariant of scheme)
+        and an E(B-V) prior bound of ebv_max, with the effective sample size of the new weights (None if no fit is stored)
+
+    the new prior must lie inside the old one (covered), otherwise the samples miss part of it and the object needs a refit """
+    options = zcal.options if options is None else options
+    scheme = utils.GetScheme(scheme)
+    new_scheme = scheme if new_scheme is None else utils.GetScheme(new_scheme)
+    old_ebv_max = options['ebv_max'] if old_ebv_max is None else old_ebv_max
+    ebv_max = old_ebv_max if ebv_max is None else ebv_max
+    fluxes = [np.asarray(f, dtype=float) for f in (oiii, oii, hb, neiii)]
+
+    stored = _Load(id, scheme, options)
+    if stored is None:
+        return None
+    samples, logwt, logl_old = stored
+
+    # likelihood ratio under the new error model (stored likelihoods are used where available)
+    logl_new = _LogL(new_scheme, fluxes, dust)
+    if logl_new is None or len(samples) == 0:
+        return None
+    logl_new = logl_new.batch(samples)
+    logl_old = _LogL(scheme, fluxes, dust).batch(samples) if logl_old is None else logl_old
+
+    # uniform priors, so the prior ratio is the new support (up to a constant)
+    inside = (samples[:, 0] >= new_scheme.range[0] - 12.) & (samples[:, 0] <= new_scheme.range[1] - 12.)
+    if dust:
+        inside &= samples[:, 1] <= ebv_max
+    covered = (new_scheme.range[0] >= scheme.range[0]) & (new_scheme.range[1] <= scheme.range[1]) & \
+              ((not dust) or (ebv_max <= old_ebv_max))
+
+    logw = np.where(inside, logwt + logl_new - logl_old, -np.inf)
+    if not np.any(np.isfinite(logw)):
+        return {'logOHp12': np.ones(3) * -999.0, 'EBV': np.ones(3) * -999.0, 'ess': 0., 'covered': bool(covered)}
+    weights = np.exp(logw - np.max(logw))
+    weights /= weights.sum()
+
+    # weighted quantiles (as the fits report them)
+    from dynesty import utils as dyfunc
+    oh = dyfunc.quantile(samples[:, 0], [0.16, 0.50, 0.84], weights=weights)
+    logOHp12 = np.array([oh[1]+12, oh[2]-oh[1], oh[1]-oh[0]])
+    if dust:
+        ebv = dyfunc.quantile(samples[:, 1], [0.16, 0.50, 0.84], weights=weights)
+        EBVs = np.array([ebv[1], ebv[2]-ebv[1], ebv[1]-ebv[0]])
+    else:
+        EBVs = np.full(3, np.nan)
+    return {'logOHp12': logOHp12, 'EBV': EBVs, 'ess': float(1. / np.sum(weights ** 2)), 'covered': bool(covered)}
+
+def ReweightCatalogue(ids:np.ndarray, scheme:str, oiii:np.ndarray, oii:np.ndarray, hb:np.ndarray, neiii:np.ndarray,
+                      new_scheme:str = None, ebv_max:float = None, dust:bool = True, min_ess:float = 100.,
+                      refit:bool = True, nworkers:int = None, seed:int = None) -> tuple:
+    """ Reweights a catalogue's stored fits (batch.result_dtype summaries) and the ESS of each, refitting under
+        new_scheme / ebv_max only the objects with ESS below min_ess, an uncovered prior or no stored fit """
+
+    ids = np.atleast_1d(ids).astype(str)
+    fluxes = [np.asarray(f, dtype=float).reshape(len(ids), 2) for f in (oiii, oii, hb, neiii)]
+    new_scheme = utils.GetScheme(scheme if new_scheme is None else new_scheme)
+    ebv_max = zcal.options['ebv_max'] if ebv_max is None else ebv_max
+
+    results = np.zeros(len(ids), dtype=batch.result_dtype)
+    results['id'] = ids
+    ess = np.zeros(len(ids))
+    for i, id in enumerate(ids):
+        fit = Reweight(id, scheme, *[f[i] for f in fluxes], new_scheme=new_scheme, ebv_max=ebv_max, dust=dust)
+        if fit is None:
+            continue
+        ess[i] = fit['ess'] if fit['covered'] else 0.
+        results[i]['logOHp12'], results[i]['logOHp12_up'], results[i]['logOHp12_lo'] = fit['logOHp12']
+        results[i]['EBV'], results[i]['EBV_up'], results[i]['EBV_lo'] = fit['EBV']
+
+    # refit what the stored samples cannot represent
+    rest = np.flatnonzero(ess < min_ess)
+    if refit and len(rest):
+        if zcal.options['verbose']:
+            print(f'-> [zcal]: refitting {len(rest)} of {len(ids)} objects (ESS < {min_ess}).')
+        previous = zcal.options['ebv_max']
+        zcal.options['ebv_max'] = ebv_max
+        try:
+            results[rest] = batch.FitCatalogue(ids[rest], new_scheme.name, *[f[rest] for f in fluxes], dust=dust,
+                                               nworkers=nworkers, seed=seed)
+        finally:
+            zcal.options['ebv_max'] = previous
+    return results, ess
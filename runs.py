@@ -0,0 +1,125 @@
+# imports
+import zcal
+from zcal import utils, cache, batch, store, fitting
+import numpy as np
+import os, json
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+# -=-=-=- RUN MANIFEST -=-=-=-
+
+def _FitObject(task:tuple) -> tuple:
+    """ batch._FitObject, also returning the object's store records (written by the parent, see RunManager.Run) """
+    with store.Captured() as records:
+        fit = batch._FitObject(task)
+    return fit, records
+
+class RunManager:
+    """ Resumable catalogue run: completed objects are appended to {run_dir}/manifest.jsonl as they finish """
+
+    def __init__(self, run_dir:str, scheme:str, dust:bool = True, checkpoint:bool = False):
+        self.run_dir = run_dir
+        self.scheme = utils.GetScheme(scheme)
+        self.dust = dust
+        self.path = os.path.join(run_dir, 'manifest.jsonl')
+        self.checkpoint_dir = os.path.join(run_dir, 'checkpoints') if checkpoint else None
+        self.stats = [] # stats records of objects fitted by this manager (options['stats'])
+        os.makedirs(run_dir, exist_ok=True)
+
+        # a manifest belongs to one scheme / fit type (and calibration)
+        header = {'scheme': self.scheme.name, 'dust': dust, 'fingerprint': cache.Fingerprint(self.scheme)}
+        if os.path.exists(self.path):
+            with open(self.path) as infile:
+                first = infile.readline()
+            if first and json.loads(first) != header:
+                raise ValueError(f'{self.path} was written by a different run ({first.strip()})')
+            if not first:
+                self._Write(header)
+        else:
+            self._Write(header)
+
+    def _Write(self, record:dict) -> None:
+        # one line per record, synced so a killed run loses at most the line being written
+        with open(self.path, 'a') as outfile:
+            outfile.write(json.dumps(record) + '\n')
+            outfile.flush()
+            os.fsync(outfile.fileno())
+
+    def Completed(self) -> dict:
+        """ Summaries of every object already in the manifest, {id: (logOHp12, EBVs)} """
+        completed = {}
+        with open(self.path) as infile:
+            lines = infile.readlines()[1:]
+        for line in lines:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue # partial line from an interrupted write
+            completed[record['id']] = (np.array(record['logOHp12'], dtype=float), np.array(record['EBV'], dtype=float))
+        return completed
+
+    def Record(self, id:str, logOHp12:np.ndarray, EBVs:np.ndarray) -> None:
+        """ Marks an object as completed """
+        self._Write({'id': str(id), 'logOHp12': [float(v) for v in logOHp12], 'EBV': [float(v) for v in EBVs]})
+
+    def Run(self, ids:np.ndarray, oiii:np.ndarray, oii:np.ndarray, hb:np.ndarray, neiii:np.ndarray,
+            nworkers:int = None, chunksize:int = 8, seed:int = None, retry_failed:bool = False) -> np.ndarray:
+        """ Fits every object not yet in the manifest, returning summaries of the whole catalogue (as batch.FitCatalogue) """
+
+        ids = np.atleast_1d(ids).astype(str)
+        fluxes = [np.asarray(f, dtype=float).reshape(len(ids), 2) for f in (oiii, oii, hb, neiii)]
+        options = dict(zcal.options, checkpoint_dir=self.checkpoint_dir)
+        fitting.CheckMethod(options, self.dust)
+
+        # seeds follow each object's id, so a resumed object gets the same seed as in an uninterrupted run
+        completed = self.Completed()
+        if retry_failed:
+            completed = {id:fit for id, fit in completed.items() if fit[0][0] != -999.0}
+        seeds = batch.ObjectSeeds(seed, ids)
+        tasks = [(ids[i], self.scheme.name, [f[i] for f in fluxes], self.dust, seeds[i], options)
+                 for i in range(len(ids)) if ids[i] not in completed]
+        if zcal.options['verbose']:
+            print(f'-> [zcal]: {len(ids) - len(tasks)} of {len(ids)} objects already complete.')
+
+        # workers hand their store records back, and an object is only recorded once its shard is on disk
+        # (so a killed run loses at most the objects of an unwritten shard, which are fitted again)
+        store_dir = options['store_dir'] if options['output'] == 'store' else None
+        unwritten = []
+        def Finish(id:str, fit:tuple, records:list) -> None:
+            completed[id] = fit[:2]
+            if fit[2] is not None:
+                self.stats.append(fit[2])
+            store.AppendCaptured(records)
+            unwritten.append((id, fit))
+            if store_dir is None or store.Buffered(store_dir) == 0:
+                Flush()
+
+        def Flush() -> None:
+            for id, fit in unwritten:
+                self.Record(id, *fit[:2])
+            unwritten.clear()
+
+        try:
+            if nworkers == 1:
+                for task in tasks:
+                    Finish(task[0], *_FitObject(task))
+            elif tasks:
+                with ProcessPoolExecutor(max_workers=nworkers, initializer=batch._InitWorker,
+                                         initargs=({key:value for key, value in options.items() if not callable(value)},
+                                                   utils.schemes)) as executor:
+                    futures = {executor.submit(_FitObject, task): task[0] for task in tasks}
+                    for future in as_completed(futures):
+                        Finish(futures[future], *future.result())
+        finally:
+            # objects finished before an interruption are kept
+            if store_dir is not None:
+                store.FlushAll()
+            Flush()
+
+        # collect summaries in catalogue order
+        results = np.zeros(len(ids), dtype=batch.result_dtype)
+        results['id'] = ids
+        for i, id in enumerate(ids):
+            logOHp12, EBVs = completed[id]
+            results[i]['logOHp12'], results[i]['logOHp12_up'], results[i]['logOHp12_lo'] = logOHp12
+            results[i]['EBV'], results[i]['EBV_up'], results[i]['EBV_lo'] = EBVs
+        return results
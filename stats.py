@@ -0,0 +1,116 @@
+# imports
+import zcal
+import numpy as np
+import os, time, functools, inspect, threading, contextlib
+
+# per-thread record of the fit in progress, and of the last completed fit
+_local = threading.local()
+_null = contextlib.nullcontext()
+
+# -=-=-=- PER-FIT RECORDS -=-=-=-
+
+def Current() -> dict:
+    """ Stats record of the fit in progress on this thread (None when options['stats'] is off) """
+    return getattr(_local, 'record', None)
+
+def Last() -> dict:
+    """ Stats record of the last completed fit on this thread """
+    return getattr(_local, 'last', None)
+
+def Reset() -> None:
+    _local.last = None
+
+class _Stage:
+    """ Adds the wall time of a block to record['stages'][name] """
+    __slots__ = ('record', 'name', 'start')
+
+    def __init__(self, record:dict, name:str):
+        self.record, self.name = record, name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc):
+        stages = self.record['stages']
+        stages[self.name] = stages.get(self.name, 0.) + time.perf_counter() - self.start
+
+def Stage(record:dict, name:str):
+    """ Context timing one stage of a fit (a shared no-op when record is None) """
+    return _null if record is None else _Stage(record, name)
+
+def CountLogL(record:dict, npoints:int, seconds:float) -> None:
+    """ Tallies one (batched) likelihood call """
+    record['logl_calls'] += 1
+    record['logl_points'] += npoints
+    record['stages']['likelihood'] = record['stages'].get('likelihood', 0.) + seconds
+
+def Sampler(record:dict, results, settings:dict = None) -> None:
+    """ Copies the sampler's iteration / call counts, efficiency and settings into a record """
+    if record is not None:
+        record['niter'] = int(results['niter'])
+        record['ncall'] = int(np.sum(results['ncall']))
+        record['eff'] = float(results['eff'])
+        if settings is not None:
+            record['sampler_settings'] = dict(settings)
+
+def Instrumented(fit):
+    """ Wraps a FitZg_* method so it fills a stats record (and optionally a cProfile dump) when options['stats'] is set """
+    signature = inspect.signature(fit)
+
+    @functools.wraps(fit)
+    def wrapper(*args, **kwargs):
+        bound = signature.bind(*args, **kwargs)
+        options = zcal.options if bound.arguments.get('options') is None else bound.arguments['options']
+        if not options.get('stats'):
+            return fit(*args, **kwargs)
+
+        scheme = bound.arguments['scheme']
+        record = {'id': str(bound.arguments['id']), 'scheme': getattr(scheme, 'name', str(scheme).lower()),
+                  'fit': fit.__name__, 'method': options['method'], 'stages': {},
+                  'logl_calls': 0, 'logl_points': 0, 'niter': 0, 'ncall': 0, 'eff': np.nan, 'cached': False}
+        profiler = None
+        if options.get('profile_dir') is not None:
+            import cProfile
+            profiler = cProfile.Profile()
+
+        _local.record = record
+        start = time.perf_counter()
+        try:
+            if profiler is None:
+                return fit(*args, **kwargs)
+            return profiler.runcall(fit, *args, **kwargs)
+        finally:
+            record['total'] = time.perf_counter() - start
+            # sampler time excluding likelihood calls is dynesty's own bookkeeping
+            if 'sampler' in record['stages']:
+                record['stages']['dynesty'] = record['stages']['sampler'] - record['stages'].get('likelihood', 0.)
+            _local.record, _local.last = None, record
+            if profiler is not None:
+                os.makedirs(options['profile_dir'], exist_ok=True)
+                profiler.dump_stats(f'{options["profile_dir"]}/{record["id"]}_{record["scheme"]}_{fit.__name__}.prof')
+
+    return wrapper
+
+# -=-=-=- AGGREGATION -=-=-=-
+
+def Aggregate(records:list) -> dict:
+    """ Totals and per-fit distributions (median, 95th percentile, max) of a batch of stats records """
+    records = [r for r in records if r is not None]
+    summary = {'nfits': len(records)}
+    if not records:
+        return summary
+
+    def Describe(values:list) -> dict:
+        values = np.asarray(values, dtype=float)
+        return {'total': float(np.sum(values)), 'median': float(np.median(values)),
+                'p95': float(np.percentile(values, 95)), 'max': float(np.max(values))}
+
+    summary['total'] = Describe([r['total'] for r in records])
+    stages = sorted(set(name for r in records for name in r['stages']))
+    summary['stages'] = {name: Describe([r['stages'].get(name, 0.) for r in records]) for name in stages}
+    for key in ('logl_calls', 'logl_points', 'niter', 'ncall'):
+        summary[key] = Describe([r[key] for r in records])
+    summary['cached'] = int(sum(r.get('cached', False) for r in records))
+    summary['eff'] = float(np.nanmedian([r['eff'] for r in records])) if any(np.isfinite(r['eff']) for r in records) else np.nan
+    summary['slowest'] = [(r['id'], r['total']) for r in sorted(records, key=lambda r: -r['total'])[:5]]
+    return summary
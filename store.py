@@ -0,0 +1,192 @@
+# imports
+import numpy as np
+import os, glob, json, uuid, threading, contextlib
+from multiprocessing import util as mputil
+
+# -=-=-=- WRITING -=-=-=-
+
+class StoreWriter:
+    """ Buffers per-object summaries and posterior samples, writing them to .npz shards of shard_size objects """
+
+    def __init__(self, store_dir:str, shard_size:int = 256):
+        self.store_dir = store_dir
+        self.shard_size = shard_size
+        self.records = []
+        self.nshards = 0
+        self.lock = threading.Lock()
+        os.makedirs(store_dir, exist_ok=True)
+
+    def Append(self, record:dict) -> None:
+        with self.lock:
+            self.records.append(record)
+            if len(self.records) >= self.shard_size:
+                self._Write()
+
+    def Flush(self) -> None:
+        with self.lock:
+            if self.records:
+                self._Write()
+
+    def _Write(self) -> None:
+        records, self.records = self.records, []
+
+        # columns (samples concatenated, indexed by offsets)
+        samples = [r['samples'] for r in records]
+        columns = {'id': np.array([r['id'] for r in records], dtype=str),
+                   'scheme': np.array([r['scheme'] for r in records], dtype=str),
+                   'offsets': np.cumsum([0] + [len(s) for s in samples]),
+                   'samples': np.concatenate(samples).astype(np.float32) if samples else np.zeros((0, 2), np.float32)}
+        for key in ('logOHp12', 'EBV', 'logz', 'logzerr', 'niter', 'ncall', 'eff', 'settings'):
+            columns[key] = np.array([r[key] for r in records])
+
+        # one file per shard, written atomically under a unique name (a later process may reuse this pid and
+        # thread id, and restarts the counter), so no shard is ever replaced
+        name = f'shard_{os.getpid()}_{threading.get_ident()}_{self.nshards:05d}_{uuid.uuid4().hex[:12]}'
+        tmp = os.path.join(self.store_dir, f'.{name}.tmp.npz')
+        np.savez(tmp, **columns)
+        os.replace(tmp, os.path.join(self.store_dir, f'{name}.npz'))
+        self.nshards += 1
+
+# open writers of this process (flushed at exit, including pool workers)
+_writers = {}
+_writers_lock = threading.Lock()
+
+def _AfterFork() -> None:
+    # a forked child starts with no writers, so it never writes its parent's buffered records again
+    global _writers_lock
+    _writers.clear()
+    _writers_lock = threading.Lock()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_AfterFork)
+
+def Writer(store_dir:str, shard_size:int = 256) -> StoreWriter:
+    """ Returns this process's writer for a store directory (buffering up to the latest shard_size records) """
+    with _writers_lock:
+        if store_dir not in _writers:
+            _writers[store_dir] = StoreWriter(store_dir, shard_size)
+            # registered here (not at import) so forked pool workers flush too
+            mputil.Finalize(_writers[store_dir], _writers[store_dir].Flush, exitpriority=10)
+        _writers[store_dir].shard_size = shard_size
+        return _writers[store_dir]
+
+def FlushAll() -> None:
+    """ Writes any buffered records of every open writer """
+    for writer in list(_writers.values()):
+        writer.Flush()
+
+def Buffered(store_dir:str) -> int:
+    """ Number of records this process has appended to a store but not yet written """
+    writer = _writers.get(store_dir)
+    return 0 if writer is None else len(writer.records)
+
+# records held back by Captured (None when appending writes them)
+_captured = None
+
+@contextlib.contextmanager
+def Captured():
+    """ Collects the (store_dir, shard_size, record) of every Append inside the block instead of buffering them,
+        so a worker can hand its records to the parent (see AppendCaptured) and lose nothing if it is killed """
+    global _captured
+    previous, _captured = _captured, []
+    try:
+        yield _captured
+    finally:
+        _captured = previous
+
+def AppendCaptured(records:list) -> None:
+    """ Appends records collected by Captured (e.g. in a worker) to this process's writers """
+    for store_dir, shard_size, record in records:
+        Writer(store_dir, shard_size).Append(record)
+
+def Append(store_dir:str, id:str, scheme:str, results, logOHp12:np.ndarray, EBVs:np.ndarray,
+           nsamples:int = 500, shard_size:int = 256, rstate:np.random.Generator = None, settings:dict = None) -> None:
+    """ Adds a fit's summaries and (downsampled, equal-weight) posterior samples to a store """
+    from dynesty import utils as dyfunc
+
+    # equal-weight posterior samples, always stored as (log O/H, E(B-V))
+    samples = np.zeros((0, 2))
+    if nsamples:
+        rstate = np.random.default_rng() if rstate is None else rstate
+        weights = np.exp(results['logwt'] - results['logz'][-1])
+        equal = dyfunc.resample_equal(results['samples'], weights / weights.sum(), rstate=rstate)
+        equal = equal[rstate.choice(len(equal), size=min(nsamples, len(equal)), replace=False)]
+        samples = np.full((len(equal), 2), np.nan)
+        samples[:, :equal.shape[1]] = equal[:, :2]
+        samples[:, 0] += 12.
+
+    _Add(store_dir, shard_size, {'id': str(id), 'scheme': scheme, 'logOHp12': logOHp12, 'EBV': EBVs,
+                                 'logz': results['logz'][-1], 'logzerr': results['logzerr'][-1],
+                                 'niter': results['niter'], 'ncall': np.sum(results['ncall']), 'eff': results['eff'],
+                                 'samples': samples, 'settings': json.dumps(settings or {})})
+
+def AppendSummary(store_dir:str, id:str, scheme:str, logOHp12:np.ndarray, EBVs:np.ndarray, nodes:np.ndarray = None,
+                  weights:np.ndarray = None, logz:float = np.nan, nsamples:int = 500, shard_size:int = 256,
+                  rstate:np.random.Generator = None, settings:dict = None) -> None:
+    """ Adds the summaries of a fit without a sampler (grid, quadrature, Monte Carlo, Laplace) to a store, with
+        equal-weight samples drawn from its weighted (12+log(O/H), E(B-V)) posterior nodes where it has them """
+    samples = np.zeros((0, 2))
+    if nsamples and nodes is not None:
+        rstate = np.random.default_rng() if rstate is None else rstate
+        samples = nodes[rstate.choice(len(nodes), size=nsamples, p=weights / np.sum(weights))]
+
+    _Add(store_dir, shard_size, {'id': str(id), 'scheme': scheme, 'logOHp12': logOHp12, 'EBV': EBVs,
+                                 'logz': logz, 'logzerr': np.nan, 'niter': 0, 'ncall': 0, 'eff': np.nan,
+                                 'samples': samples, 'settings': json.dumps(settings or {})})
+
+def _Add(store_dir:str, shard_size:int, record:dict) -> None:
+    if _captured is not None:
+        _captured.append((store_dir, shard_size, record))
+    else:
+        Writer(store_dir, shard_size).Append(record)
+
+# -=-=-=- READING -=-=-=-
+
+class StoreReader:
+    """ Lazy reader of a results store: shards are only opened when their columns are requested """
+
+    def __init__(self, store_dir:str):
+        self.paths = sorted(glob.glob(os.path.join(store_dir, 'shard_*.npz')))
+        self._shards = {}
+        self._columns = {}
+
+        # index of (shard, row) for every object
+        self.index = {}
+        for s in range(len(self.paths)):
+            for row, (id, scheme) in enumerate(zip(self._Column(s, 'id'), self._Column(s, 'scheme'))):
+                self.index[(str(id), str(scheme))] = (s, row)
+
+    def _Column(self, s:int, key:str) -> np.ndarray:
+        # each column of a shard is read at most once
+        if (s, key) not in self._columns:
+            if s not in self._shards:
+                self._shards[s] = np.load(self.paths[s])
+            self._columns[(s, key)] = self._shards[s][key]
+        return self._columns[(s, key)]
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def Summaries(self) -> dict:
+        """ Concatenated summary columns of every object """
+        keys = ('id', 'scheme', 'logOHp12', 'EBV', 'logz', 'logzerr', 'niter', 'ncall', 'eff')
+        return {key: np.concatenate([self._Column(s, key) for s in range(len(self.paths))]) for key in keys}
+
+    def Get(self, id:str, scheme:str) -> dict:
+        """ Summaries and samples (12+log(O/H), E(B-V)) of a single object """
+        s, row = self.index[(str(id), scheme.lower())]
+        offsets = self._Column(s, 'offsets')
+        record = {key: self._Column(s, key)[row] for key in ('logOHp12', 'EBV', 'logz', 'logzerr', 'niter', 'ncall', 'eff')}
+        record['samples'] = self._Column(s, 'samples')[offsets[row]:offsets[row+1]]
+        # sampler settings (shards written before they were recorded have none)
+        record['settings'] = json.loads(str(self._Column(s, 'settings')[row])) if 'settings' in self._shards[s].files else {}
+        return record
+
+    def Close(self) -> None:
+        for shard in self._shards.values():
+            shard.close()
+        self._shards, self._columns = {}, {}
+
+def ReadStore(store_dir:str) -> StoreReader:
+    """ Opens a results store for (lazy) reading """
+    return StoreReader(store_dir)
@@ -1,63 +1,77 @@
 # handle imports
 import numpy as np
-import matplotlib.pyplot as plt
 import zcal
 import sys
+from functools import lru_cache
+from types import MappingProxyType
+from typing import NamedTuple, Callable
+
+# -=-=-=- CALIBRATION COEFFICIENTS -=-=-=-
+# polynomial coefficients in x (highest order first) of each calibration, the single source of the calibrations below
+
+coefficients = {
+    'sanders': {
+        'O3'    : [-0.453, -0.072, 0.834],
+        'O2'    : [1.069, 0.067],
+        'R23'   : [-0.331, 0.026, 1.1017],
+        'O32'   : [-1.153, 0.723],
+        'Ne3O2' : [-0.998, -0.386],
+    },
+    'nakajima': {
+        'O3'    : [-0.637, -2.832, -3.182, -0.277],
+        'O2'    : [-1.145, -4.117, -4.586, -1.044, 0.429],
+        'R23'   : [-0.274, -1.392, -1.474, 0.515],
+        'O32'   : [-1.201, -2.722, -0.693],
+        'Ne3O2' : [0.070, 0.161, -0.317],
+    },
+    'bian': {
+        'O3'    : [-0.1747, 3.4277, -21.6211, 43.9836],
+        'O2'    : [np.nan],
+        'R23'   : [-0.32293, 7.2954, 54.8284, 138.0430],
+        'O32'   : [-1. / 0.59, 8.54 / 0.59],
+        'Ne3O2' : [-1. / 0.63, 7.80 / 0.63],
+    },
+}
+
+class Polynomial(NamedTuple):
+    """ Picklable calibration (ratio as a function of x) built from its coefficients, highest order first """
+    coefficients: tuple
+
+    def __call__(self, x:np.ndarray) -> np.ndarray:
+        return np.polyval(self.coefficients, x)
+
+def _Calibrations(scheme:str) -> list:
+    return [Polynomial(tuple(coefficients[scheme][cal])) for cal in ('O3', 'O2', 'R23', 'O32', 'Ne3O2')]
 
 # -=-=-=- SANDERS 2023 CALIBRATIONS -=-=-=-
-# link: 
-
-def SandersO3(x:float) -> float:
-    return 0.834 - (0.072 * x) - (0.453 * x * x)
-
-def SandersO2(x:float) -> float:
-    return 0.067 + (1.069 * x) 
-
-def SandersR23(x:float) -> float:
-    return 1.1017 + (0.026 * x) - (0.331 * x * x)
-
-def SandersO32(x:float) -> float:
-    return 0.723 - (1.153 * x) 
+# link: 
 
-def SandersNe3O2(x:float) -> float:
-    return -0.386 - (0.998 * x) 
+SandersO3, SandersO2, SandersR23, SandersO32, SandersNe3O2 = _Calibrations('sanders')
 
 # -=-=-=- NAKAJIMA 2022 CALIBRATIONS -=-=-=-
-# link: 
-
-def NakajimaO3(x:float) -> float:
-    return -0.277 - (3.182 * x) - (2.832 * x * x) - (0.637 * x * x * x)
-
-def NakajimaO2(x:float) -> float:
-    return 0.429 - (1.044 * x) - (4.586 * x * x) - (4.117 * x * x * x) - (1.145 * x * x * x * x) 
-
-def NakajimaR23(x:float) -> float:
-    return 0.515 - (1.474 * x) - (1.392 * x * x) - (0.274 * x * x * x)
-
-def NakajimaO32(x:float) -> float:
-    return -0.693 - (2.722 * x) - (1.201 * x * x)
+# link: 
 
-def NakajimaNe3O2(x:float) -> float:
-    return -0.317 + (0.161 * x) + (0.070 * x * x)
+NakajimaO3, NakajimaO2, NakajimaR23, NakajimaO32, NakajimaNe3O2 = _Calibrations('nakajima')
 
 # -=-=-=- BIAN CALIBRATIONS -=-=-=- 
 # link: 
 
-def BianO3(x:float) -> float:
-    return 43.9836  + (-21.6211 * x) + (3.4277 * x ** 2) + (-0.1747 * x ** 3)
-    
-def BianO2(x:float) -> float:
-    print('-> [ERROR]: Bian O2 calibration does not exist. Returning nan.')
-    return np.nan
-
-def BianR23(x:float) -> float:
-    return 138.0430 + (54.8284 * x) + (7.2954 * x ** 2) - (0.32293 * x ** 3)
+# (there is no Bian O2 calibration, its NaN coefficient returns NaN)
+BianO3, BianO2, BianR23, BianO32, BianNe3O2 = _Calibrations('bian')
 
-def BianO32(x:float) -> float:
-    return (8.54 - x) / 0.59
+def CoefficientTable(scheme:str, calibrations:list) -> np.ndarray:
+    """ Stacks the (zero-padded) coefficients of the given calibrations into an (n, order+1) array """
+    polys = [GetScheme(scheme).coefficients[cal] for cal in calibrations]
+    order = max([len(p) for p in polys], default=1)
+    return np.array([[0.] * (order - len(p)) + list(p) for p in polys]).reshape(len(polys), order)
 
-def BianNe3O2(x:float) -> float:
-    return (7.80 - x) / 0.63
+def Horner(coeffs:np.ndarray, x:np.ndarray) -> np.ndarray:
+    """ Evaluates a stack of polynomials at x via Horner's method, returning shape (..., n) """
+    x = np.asarray(x, dtype=float)[..., None]
+    model = np.zeros(x.shape[:-1] + (coeffs.shape[0],)) + coeffs[:, 0]
+    for c in coeffs.T[1:]:
+        model = model * x + c
+    return model
 
 # -=-=-=- FITTING PARAMETER CONVERSIONS -=-=-=-
 def Bian_logOH(x:np.ndarray) -> np.ndarray:
@@ -78,10 +92,173 @@ def Nakajima_logOH(x:np.ndarray) -> np.ndarray:
 def Nakajima_x(logOH:np.ndarray) -> np.ndarray:
     return 12 + logOH - 8.69
 
+# -=-=-=- CALIBRATION REGISTRY -=-=-=-
+# each scheme is data: coefficients (above), intrinsic scatters, valid range, x <-> log(O/H) conversion,
+# the diagnostics it calibrates and its [OIII] convention (the factor applied to 5007 in O3 and O32)
+
+schemes = {
+    'sanders': {
+        'range'        : (6.7, 9.0),
+        'coefficients' : coefficients['sanders'],
+        'errors'       : {'O3': 0.09, 'O2': 0.22, 'R23': 0.06, 'O32': 0.29, 'Ne3O2': 0.24},
+        'calibrations' : {'O3': SandersO3, 'O2': SandersO2, 'R23': SandersR23, 'O32': SandersO32, 'Ne3O2': SandersNe3O2},
+        'x_to_oh'      : Sanders_logOH,
+        'oh_to_x'      : Sanders_x,
+        'diagnostics'  : ('O3', 'O2', 'R23', 'O32', 'Ne3O2'),
+        'oiii_factor'  : 4/3,
+    },
+    'bian': {
+        'range'        : (6.7, 9.0),
+        'coefficients' : coefficients['bian'],
+        'errors'       : {'O3': 0.10, 'O2': 0.13, 'R23': 0.08, 'O32': 0.19, 'Ne3O2': 0.20},
+        'calibrations' : {'O3': BianO3, 'O2': BianO2, 'R23': BianR23, 'O32': BianO32, 'Ne3O2': BianNe3O2},
+        'x_to_oh'      : Bian_logOH,
+        'oh_to_x'      : Bian_x,
+        'diagnostics'  : ('O3', 'O32', 'Ne3O2'),
+        'oiii_factor'  : 4/3,
+    },
+    'nakajima': {
+        'range'        : (6.7, 9.0), # varies for diagnostic
+        'coefficients' : coefficients['nakajima'],
+        'errors'       : {'O3': 0.16, 'O2': 0.27, 'R23': 0.10, 'O32': 0.39, 'Ne3O2': 0.39},
+        'calibrations' : {'O3': NakajimaO3, 'O2': NakajimaO2, 'R23': NakajimaR23, 'O32': NakajimaO32, 'Ne3O2': NakajimaNe3O2},
+        'x_to_oh'      : Nakajima_logOH,
+        'oh_to_x'      : Nakajima_x,
+        'diagnostics'  : ('O3', 'O2', 'R23', 'O32', 'Ne3O2'),
+        'oiii_factor'  : 1.0, # 5007 only (except in R23)
+    },
+}
+
+class Conversion(NamedTuple):
+    """ Picklable x = 12 + log(O/H) - offset conversion (to_oh=True for its inverse) """
+    offset: float
+    to_oh: bool
+
+    def __call__(self, value:np.ndarray) -> np.ndarray:
+        return value - 12. + self.offset if self.to_oh else 12. + value - self.offset
+
+def RegisterScheme(name:str, coefficients:dict, errors:dict, range:tuple = (6.7, 9.0), x_offset:float = 8.69,
+                   diagnostics:tuple = None, oiii_factor:float = 4/3) -> None:
+    """ Adds (or replaces) a calibration scheme from its polynomial coefficients in x = 12 + log(O/H) - x_offset,
+        calibrating the given diagnostics (by default those with finite coefficients) """
+    missing = [cal for cal in ('O3', 'O2', 'R23', 'O32', 'Ne3O2') if cal not in coefficients or cal not in errors]
+    if missing:
+        raise ValueError(f'scheme {name} is missing coefficients or errors for {missing}')
+    if diagnostics is None:
+        diagnostics = tuple(cal for cal in ('O3', 'O2', 'R23', 'O32', 'Ne3O2') if np.all(np.isfinite(coefficients[cal])))
+    _Register(name, {
+        'range'        : tuple(range),
+        'coefficients' : {cal: list(c) for cal, c in coefficients.items()},
+        'errors'       : dict(errors),
+        'calibrations' : {cal: Polynomial(tuple(c)) for cal, c in coefficients.items()},
+        'x_to_oh'      : Conversion(x_offset, True),
+        'oh_to_x'      : Conversion(x_offset, False),
+        'diagnostics'  : tuple(diagnostics),
+        'oiii_factor'  : float(oiii_factor),
+    })
+
+def RegisterVariant(name:str, base:str, errors:dict = None, range:tuple = None) -> None:
+    """ Registers a copy of a scheme with (some of) its calibration errors and / or its range replaced """
+    if base.lower() not in schemes:
+        raise ValueError(f'unknown calibration scheme {base}')
+    entry = dict(schemes[base.lower()])
+    entry['errors'] = dict(entry['errors'], **({} if errors is None else errors))
+    entry['range'] = entry['range'] if range is None else tuple(range)
+    _Register(name, entry)
+
+def _Register(name:str, entry:dict) -> None:
+    schemes[name.lower()] = entry
+    # schemes and inverse tables are rebuilt on next use
+    _BuildScheme.cache_clear()
+    _InverseTable.cache_clear()
+
+def SyncSchemes(entries:dict) -> None:
+    """ Registers the schemes of another process's registry (e.g. in a spawned worker, which starts with the
+        built-in schemes only) that this process lacks or has with different contents """
+    from zcal import cache
+    for name, entry in entries.items():
+        if name not in schemes or cache.Hash(schemes[name]) != cache.Hash(entry):
+            _Register(name, entry)
+
+@lru_cache(maxsize=None)
+def _InverseTable(name:str, calibration:str, n:int) -> tuple:
+    scheme = GetScheme(name)
+    oh = np.linspace(scheme.range[0] - 12., scheme.range[1] - 12., n)
+    ratio = Horner(np.array([scheme.coefficients[calibration]], dtype=float), scheme.oh_to_x(oh))[:, 0]
+    if not np.all(np.isfinite(ratio)):
+        return ()
+
+    # split into monotonic branches at the turning points
+    turns = np.flatnonzero(np.diff(np.sign(np.diff(ratio))) != 0) + 1
+    branches = []
+    for idx in np.split(np.arange(n), turns):
+        idx = np.arange(max(idx[0] - 1, 0), idx[-1] + 1) # branches share their turning point
+        order = np.argsort(ratio[idx])
+        r, o = ratio[idx][order], oh[idx][order]
+        r.setflags(write=False); o.setflags(write=False)
+        branches.append((r, o))
+    return tuple(branches)
+
+def InverseTable(scheme:str, calibration:str, n:int = 2001) -> tuple:
+    """ (Cached) monotonic branches (ratio, log O/H) of a calibration over the scheme's range """
+    return _InverseTable(GetScheme(scheme).name, calibration, n)
+
+def Invert(scheme:str, calibration:str, ratio:np.ndarray, n:int = 2001) -> np.ndarray:
+    """ Candidate log(O/H) (one per branch, NaN outside it) reproducing the given log ratios, shape (..., nbranch) """
+    ratio = np.asarray(ratio, dtype=float)
+    branches = InverseTable(scheme, calibration, n)
+    return np.stack([np.interp(ratio, r, o, left=np.nan, right=np.nan) for r, o in branches], axis=-1) \
+        if branches else np.zeros(ratio.shape + (0,))
+
 # -=-=-=- RUNTIME SETTING METHODS -=-=-=-
 def SetCalibration(source:str) -> None:
     zcal.Initialise(source.lower())
 
+class CalibrationScheme(NamedTuple):
+    """ Immutable calibration scheme (calibrations, errors, range and conversions), shared between fits """
+    name: str
+    range: tuple
+    calibrations: MappingProxyType
+    errors: MappingProxyType
+    coefficients: MappingProxyType
+    wavelengths: MappingProxyType
+    x_to_oh: Callable
+    oh_to_x: Callable
+    diagnostics: tuple
+    oiii_factor: float
+
+    def __reduce__(self):
+        # rebuilt from the cache in worker processes, with its registry entry (registered schemes may not exist there)
+        return _Unpickle, (self.name, schemes[self.name])
+
+def _Unpickle(name:str, entry:dict) -> 'CalibrationScheme':
+    SyncSchemes({name: entry})
+    return GetScheme(name)
+
+@lru_cache(maxsize=None)
+def _BuildScheme(name:str) -> CalibrationScheme:
+    calibrations, errors, options, wavelengths = {}, {}, {}, {}
+    zcal.SetOptions(calibrations, errors, options, wavelengths, name)
+    return CalibrationScheme(name = name,
+                             range = tuple(options['range']),
+                             calibrations = MappingProxyType(calibrations),
+                             errors = MappingProxyType(errors),
+                             coefficients = MappingProxyType(schemes[name]['coefficients']),
+                             wavelengths = MappingProxyType(wavelengths),
+                             x_to_oh = options['x_to_oh'],
+                             oh_to_x = options['oh_to_x'],
+                             diagnostics = schemes[name]['diagnostics'],
+                             oiii_factor = schemes[name]['oiii_factor'])
+
+def GetScheme(scheme:str) -> CalibrationScheme:
+    """ Returns the (cached) calibration scheme for a given name, passing scheme objects through """
+    if isinstance(scheme, CalibrationScheme):
+        return scheme
+    # raised (not exited) since this also runs when schemes are unpickled in worker processes
+    if scheme.lower() not in schemes:
+        raise ValueError(f'unknown calibration scheme {scheme} (registered: {", ".join(schemes)})')
+    return _BuildScheme(scheme.lower())
+
 # -=-=-=- Dust Attenuation Methods -=-=-=- 
 
 def Cardelli_Attenuation(wl:np.ndarray, EBV:float, Rv:float=3.1) -> np.ndarray:
@@ -136,3 +313,18 @@ def Cardelli_Attenuation(wl:np.ndarray, EBV:float, Rv:float=3.1) -> np.ndarray:
 def DustCorrect(wl:float, wl_grid:np.ndarray, Aλ:np.ndarray) -> float:
     """ Generates the dust correction factor for a given emission line flux """
     return np.power(10, 0.4 * np.interp(x=wl, xp=wl_grid, fp=Aλ))
+
+
+@lru_cache(maxsize=None)
+def _Cardelli_k(wl:tuple, Rv:float) -> np.ndarray:
+    kλ = Cardelli_Attenuation(np.array(wl), 1.0, Rv)
+    kλ.flags.writeable = False
+    return kλ
+
+def Cardelli_k(wl:np.ndarray, Rv:float=3.1) -> np.ndarray:
+    """ Returns the (cached) Cardelli kλ = Aλ/E(B-V) coefficients evaluated at given wl in μm """
+    return _Cardelli_k(tuple(np.atleast_1d(wl).astype(float)), float(Rv))
+
+def LineAttenuation(wl:np.ndarray, EBV:float, Rv:float=3.1) -> np.ndarray:
+    """ Calculates Aλ directly at given (line) wl in μm, without a wavelength grid """
+    return EBV * Cardelli_k(wl, Rv)
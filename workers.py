@@ -0,0 +1,212 @@
+# imports
+import zcal
+from zcal import utils, batch, fitting, plotting, store
+import numpy as np
+import os, sys, gc, time, resource, collections, multiprocessing
+from multiprocessing import connection
+
+# per-object memory report returned alongside the summaries
+memory_dtype = [('id', 'U64'), ('peak_rss', 'i8'), ('rss', 'i8'), ('seconds', 'f8'), ('worker', 'i8')]
+
+# -=-=-=- MEMORY -=-=-=-
+
+def _ResetPeak() -> None:
+    # linux resets the high-water mark (VmHWM) on writing 5 to clear_refs
+    try:
+        with open('/proc/self/clear_refs', 'w') as outfile:
+            outfile.write('5')
+    except OSError:
+        pass
+
+def PeakRSS() -> int:
+    """ Peak resident memory (bytes) since the last reset (or since the process started, off linux) """
+    try:
+        with open('/proc/self/status') as infile:
+            for line in infile:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+
+def RSS() -> int:
+    """ Current resident memory (bytes) """
+    try:
+        with open('/proc/self/statm') as infile:
+            return int(infile.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except OSError:
+        return PeakRSS()
+
+def Teardown() -> None:
+    """ Releases what a fit leaves behind: open figures, the background renderer (after its queued plots) and freed heap """
+    if 'matplotlib.pyplot' in sys.modules:
+        sys.modules['matplotlib.pyplot'].close('all')
+    plotting.Shutdown()
+    gc.collect()
+    # return freed heap pages to the OS (glibc only)
+    try:
+        import ctypes
+        ctypes.CDLL('libc.so.6').malloc_trim(0)
+    except (OSError, AttributeError):
+        pass
+
+# -=-=-=- LONG-LIVED WORKERS -=-=-=-
+
+def _Worker(tasks, results, options:dict, schemes:dict, max_tasks:int, max_rss:int) -> None:
+    """ Fits the tasks of its queue until told to stop, or until max_tasks objects or max_rss bytes mean it should be replaced """
+    batch._InitWorker(options, schemes)
+    nfit = 0
+    while True:
+        item = tasks.get()
+        if item is None:
+            break
+        index, task = item
+        results.send(('start', index, None))
+
+        # store records go back with the fit and are written by the parent, so a killed worker loses none
+        _ResetPeak()
+        start = time.perf_counter()
+        with store.Captured() as records:
+            fit = batch._FitObject(task)
+        Teardown()
+        nfit += 1
+
+        rss = RSS()
+        results.send(('done', index, (fit, records, {'peak_rss': PeakRSS(), 'rss': rss, 'seconds': time.perf_counter() - start})))
+        if nfit >= max_tasks or (max_rss is not None and rss > max_rss):
+            break
+    store.FlushAll()
+    results.send(('exit', None, None))
+
+class WorkerPool:
+    """ Long-lived fitting processes for multi-day runs: each object is torn down after its fit, and workers are
+        replaced after max_tasks objects or once their resident memory exceeds max_rss bytes (a killed worker's
+        object is reported as failed) """
+
+    def __init__(self, nworkers:int = None, max_tasks:int = 100, max_rss:int = None, prefetch:int = 2):
+        self.nworkers = os.cpu_count() if nworkers is None else nworkers
+        self.max_tasks, self.max_rss, self.prefetch = max_tasks, max_rss, prefetch
+        self.options = {key:value for key, value in zcal.options.items() if not callable(value)}
+        self.workers = {} # pid: (process, task queue, result pipe)
+        self.nrecycled = 0
+        for _ in range(self.nworkers):
+            self._Start()
+
+    def _Start(self) -> None:
+        # each worker has its own task queue and result pipe, so one killed mid-read or mid-write holds
+        # no lock the others need, and its death closes the pipe
+        tasks = multiprocessing.Queue()
+        reader, writer = multiprocessing.Pipe(duplex=False)
+        worker = multiprocessing.Process(target=_Worker, args=(tasks, writer, self.options, utils.schemes,
+                                                               self.max_tasks, self.max_rss))
+        worker.start()
+        writer.close()
+        self.workers[worker.pid] = (worker, tasks, reader)
+
+    def _Replace(self, pid:int) -> None:
+        worker, tasks, reader = self.workers.pop(pid)
+        # tasks left in its queue are handed out again by Map
+        tasks.cancel_join_thread()
+        tasks.close()
+        reader.close()
+        worker.join()
+        self.nrecycled += 1
+        self._Start()
+
+    def Map(self, tasks):
+        """ Yields (index, fit, memory) for each (id, scheme, fluxes, dust, seed, options) task as it finishes """
+        tasks = enumerate(tasks)
+        pending = collections.deque() # tasks handed back by workers that exited or died before starting them
+        assigned = {} # pid: {index: task} queued on each worker
+        running = {} # pid: index of the task it is fitting
+        exhausted = False
+        while True:
+            # keep up to prefetch tasks queued per worker, so streams are never read far ahead
+            for pid, (_, queue, _) in self.workers.items():
+                assigned.setdefault(pid, {})
+                while len(assigned[pid]) < self.prefetch:
+                    if not pending:
+                        item = None if exhausted else next(tasks, None)
+                        if item is None:
+                            exhausted = True
+                            break
+                        pending.append(item)
+                    index, task = pending.popleft()
+                    queue.put((index, task))
+                    assigned[pid][index] = task
+            if exhausted and not pending and not any(assigned.values()):
+                store.FlushAll()
+                return
+
+            readers = {reader: pid for pid, (_, _, reader) in self.workers.items()}
+            for reader in connection.wait(list(readers)):
+                pid = readers[reader]
+                try:
+                    kind, index, payload = reader.recv()
+                except (EOFError, OSError):
+                    # a worker that died (e.g. killed by the OOM killer) fails its object and is replaced
+                    worker = self.workers[pid][0]
+                    worker.join()
+                    if pid in running:
+                        index = running.pop(pid)
+                        assigned[pid].pop(index)
+                        print(f'-> [zcal]: worker {pid} died (exit code {worker.exitcode}) fitting task {index}.')
+                        yield index, (np.ones(3) * -999.0, np.ones(3) * -999.0, None), \
+                            {'peak_rss': -1, 'rss': -1, 'seconds': np.nan, 'worker': pid}
+                    kind = 'exit'
+
+                if kind == 'start':
+                    running[pid] = index
+                elif kind == 'done':
+                    running.pop(pid, None)
+                    assigned[pid].pop(index)
+                    fit, records, memory = payload
+                    store.AppendCaptured(records)
+                    yield index, fit, dict(memory, worker=pid)
+                elif kind == 'exit':
+                    pending.extend(assigned.pop(pid).items())
+                    self._Replace(pid)
+
+    def Close(self) -> None:
+        for _, tasks, _ in self.workers.values():
+            tasks.put(None)
+        for worker, tasks, reader in self.workers.values():
+            worker.join()
+            tasks.close()
+            reader.close()
+        self.workers = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.Close()
+
+def FitCatalogue(ids:np.ndarray, scheme:str, oiii:np.ndarray, oii:np.ndarray, hb:np.ndarray, neiii:np.ndarray,
+                 dust:bool = True, nworkers:int = None, max_tasks:int = 100, max_rss:int = None, seed:int = None,
+                 pool:WorkerPool = None) -> tuple:
+    """ Fits a catalogue on long-lived, recycled workers (as batch.FitCatalogue), also returning each object's memory report """
+
+    ids = np.atleast_1d(ids).astype(str)
+    fluxes = [np.asarray(f, dtype=float).reshape(len(ids), 2) for f in (oiii, oii, hb, neiii)]
+    fitting.CheckMethod(zcal.options, dust)
+    seeds = batch.ObjectSeeds(seed, ids)
+    tasks = ((ids[i], utils.GetScheme(scheme).name, [f[i] for f in fluxes], dust, seeds[i], None) for i in range(len(ids)))
+
+    results = np.zeros(len(ids), dtype=batch.result_dtype)
+    results['id'] = ids
+    memory = np.zeros(len(ids), dtype=memory_dtype)
+    memory['id'] = ids
+
+    owned = pool is None
+    pool = WorkerPool(nworkers, max_tasks, max_rss) if owned else pool
+    try:
+        for i, (logOHp12, EBVs, _), usage in pool.Map(tasks):
+            results[i]['logOHp12'], results[i]['logOHp12_up'], results[i]['logOHp12_lo'] = logOHp12
+            results[i]['EBV'], results[i]['EBV_up'], results[i]['EBV_lo'] = EBVs
+            memory[i]['peak_rss'], memory[i]['rss'] = usage['peak_rss'], usage['rss']
+            memory[i]['seconds'], memory[i]['worker'] = usage['seconds'], usage['worker']
+    finally:
+        if owned:
+            pool.Close()
+    return results, memory